@@ -1,8 +1,27 @@
 #!/usr/bin/env python
+import time
+START_TIME = time.perf_counter() # for the cold-start report - before the imports, they're most of it
+
 import tcod
 import math
 import textwrap
 import random
+import copy
+import json
+import bisect
+import select
+import struct
+import argparse
+import sys
+import io
+import os
+import pickle
+import zlib
+import threading
+import heapq
+import gc
+import numpy as np
+from collections import deque, OrderedDict
 
 # ######################################################################
 # Global Game Settings
@@ -17,8 +36,16 @@ LEVEL_SCREEN_WIDTH = 40
 CHARACTER_SCREEN_WIDTH = 30
 
 LIMIT_FPS = 20  # 20 frames-per-second maximum
+STARTUP_BUDGET_MS = 500 # launch-to-menu time we're aiming for; main_menu complains if we blow it
+
+FONT_FILE = 'arial10x10.png'
+SPLASH_FILE = 'skeletonSplash2.png'
+WINDOW_TITLE = 'Python 3 + Libtcod tutorial'
 # Game Controls
 TURN_BASED = True  # turn-based game
+IDLE_WAIT_MS = 500  # turn-based: longest we sleep waiting for input before going round the loop anyway (animations, etc)
+LATENCY_SAMPLES = 1000 # input-to-present timings kept for the p50/p99 report
+BATCH_KEYS = 2000 # --renderer null: keys the bot presses before the run ends
 
 
 #########
@@ -36,6 +63,7 @@ ROOM_MIN_SIZE = 6
 FOV_ALGO = 0  #default FOV algorithm
 FOV_LIGHT_WALLS = True # light walls or not
 TORCH_RADIUS = 10
+FOV_CACHE_BYTES = 128 * 1024 # budget for remembered FOV results (~430 bytes each), least recently used go first
 
 ######
 # GUI #
@@ -47,6 +75,26 @@ color_light_wall = tcod.Color(130, 110, 50)
 color_dark_ground = tcod.Color(50, 50, 150)
 color_light_ground = tcod.Color(200, 180, 50)
 
+# lighting: a lit tile's color goes from its dark color towards its light color as the light on it goes 0 -> 1
+TORCH_COLOR = tcod.Color(255, 240, 200) # warm-ish white player torch
+BRAZIER_COLOR = tcod.Color(255, 140, 40)
+BRAZIER_RADIUS = 6
+BRAZIER_CHANCE = 25 # % of rooms that get a brazier
+FLASH_COLOR_FIRE = tcod.Color(255, 120, 0)
+FLASH_COLOR_LIGHTNING = tcod.Color(120, 160, 255)
+VISIBLE_MIN_LIGHT = 0.2 # anything in FOV gets at least this much, so it never looks unexplored
+
+# render layers, drawn bottom to top - an object's layer decides what it's drawn over, not where it sits in `objects`
+LAYER_DECALS = 0 # stairs, braziers, floor stuff (corpses are painted under all of these - see Decals)
+LAYER_ITEMS = 1
+LAYER_ACTORS = 2
+LAYER_PLAYER = 3
+RENDER_LAYERS = 4
+
+# corpses aren't objects - they're painted onto a per-level decal layer
+CORPSE_COLOR = tcod.dark_red
+CORPSE_DECAY_TURNS = 300 # turns until a corpse is gone for good - None keeps them for the whole level
+
 # sizes and coordinates relevant for the GUI
 BAR_WIDTH = 20
 PANEL_HEIGHT = 7
@@ -57,6 +105,67 @@ MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 
 INVENTORY_WIDTH = 50
+
+FORMAT_MESSAGES = True # False = never turn events into text (batch runs, nobody's reading)
+EVENT_LOG_SIZE = 100 # events kept around for the panel / a log viewer
+
+# text for each kind of logged event. Only filled in when something actually displays the event.
+# {Actor} is the actor's name capitalized
+EVENT_TEXT = {
+    'message': '{text}',
+    'attack': '{Actor} attacks {target} for {amount} HP!',
+    'attack_no_effect': '{Actor} attacks {target} but it has no effect!',
+    'boss_attack': '** {Actor} attacks {target} for {amount} HP! **',
+    'death': '{Actor} is dead! You gain {amount} XP!',
+    'stockpile': 'The {actor} loads its weapon!',
+    'roar': '{actor} roars a challenge!',
+    'charge': '{actor} draws itself up to its full height!',
+    'breathe_fire': '{actor} breathes fire!',
+    'confused': 'The eyes of the {target} glaze over. It starts to stumble around!',
+    'unconfused': 'The {actor} is no longer confused!',
+    'lightning': 'Lightning arcs to strike the {target} with a deafening crash! The {target} takes {amount} damage.',
+    'burn': 'The {target} was burned for {amount} HP.',
+    'pick_up': 'Picked up a {target}!',
+    'drop': 'You dropped a {target}.',
+    'inventory_full': 'Your inventory is full, cannot pick up {target}.',
+    'cannot_use': 'The {target} cannot be used.',
+    'level_up': 'Your battle skills grow stronger! You reached level {amount}!',
+    'item_here': 'You see a {target} here.',
+    'equip': 'Equipped {target} on {text}.',
+    'dequip': 'Dequipped {target} from {text}.',
+}
+
+################
+## Spectators ##
+################
+
+SPECTATE_HOST = '127.0.0.1' # local only
+SPECTATE_PORT = 7777
+SPECTATE_SEND_TIMEOUT = 0.05 # a viewer that can't take a frame this fast gets dropped, the game never waits on them
+
+############
+## Server ##
+############
+
+SERVE_HOST = '127.0.0.1' # local only
+SERVE_PORT = 7778
+SERVE_WORKERS = None # level generation processes - None is one per core
+SERVE_METRICS_INTERVAL = 10 # seconds between server metrics reports
+NETWORK_KEYS = 'gx>,' # besides the arrows and NETWORK_MENUS - the rest ('m', 'u') are for playing at the window
+NETWORK_MENUS = {'i': 'use', 'd': 'drop', 'c': 'sheet', 't': 'travel'} # menus the server runs itself, a key at a time
+ESCAPE_WAIT_MS = 50 # a lone ESC byte only counts as the escape key if nothing follows it this quickly - it could be half an arrow key
+
+######################
+## Best-of-N Levels ##
+######################
+
+BEST_OF = 1 # candidate levels dug per level change, best one kept. 1 = just dig one (--best-of)
+WORKER_START_TIMEOUT = 30 # seconds a new level worker waits for the rest of its pool to start
+LEVEL_BUDGET_MS = 150 # candidates not finished by then are skipped (but we always wait for at least one)
+SPAWN_DENSITY_TARGET = 0.015 # monsters + items per floor tile we'd like to see
+# how much each (normalized, roughly 0..1) metric counts towards a layout's score
+LEVEL_SCORE_WEIGHTS = {'area': 1.0, 'path': 2.0, 'rooms': 1.0, 'loops': 1.0, 'dead_ends': -1.0, 'density': -1.0}
+
 #################################
 ## Player / Creature Constants ##
 #################################
@@ -64,6 +173,9 @@ INVENTORY_WIDTH = 50
 # MAX_ROOM_MONSTERS = 3 # math'd out in Place Objects
 # MAX_ROOM_ITEMS = 2  # math'd out in Place Objects
 
+SPAWN_FILE = 'spawns.json' # monster and item stats + spawn chances
+RARE_ITEM_ODDS = 100 # rare_items chances are out of this, one roll per room
+
 LEVEL_UP_BASE = 200
 LEVEL_UP_FACTOR = 150
 
@@ -79,6 +191,59 @@ FIREBALL_DAMAGE = 8
 CONFUSE_NUM_TURNS = 10
 CONFUSE_RANGE = 8
 
+STRENGTH_BONUS = 3
+STRENGTH_TURNS = 20
+
+EFFECT_WHEEL_SIZE = 64 # timing wheel slots - effects lasting longer than this just get looked at once per lap
+
+###############
+## Snapshots ##
+###############
+
+SNAPSHOT_HISTORY = 200 # turns we can rewind
+WIZARD_MODE = False # lets the player rewind with 'u'
+
+##############
+## Autosave ##
+##############
+
+SAVE_FILE = 'savegame.sav'
+AUTOSAVE_EVERY = 50 # turns between autosaves (plus one on every level change)
+AUTOSAVE_MAX_BLOCK_MS = 2 # longest the game will wait to hand a save over - if the saver is busy past that, skip this one
+AUTOSAVE_EXIT_WAIT = 5 # seconds to wait for the last save to land when quitting
+
+############
+## Memory ##
+############
+
+MEMORY_INSTRUMENTATION = False # tracemalloc + instance counts at every level change (slows things down a bit)
+MEMORY_CEILING_MB = 256 # over this, rewind history gets thrown away to claw memory back
+MEMORY_TOP_GROWTH = 5 # source lines to show in the growth report
+
+############
+## Senses ##
+############
+
+# the player leaves scent where they walk; fighting makes noise. Both spread out and fade every turn.
+SCENT_STRENGTH = 1.0 # scent laid down on the player's tile each turn
+SCENT_SPREAD = 0.2 # share of a tile's scent that drifts to its neighbours each turn
+SCENT_DECAY = 0.97
+SCENT_THRESHOLD = 0.01 # fainter than this, monsters can't pick it up
+
+NOISE_ATTACK = 4.0 # noise made by a melee/ranged attack
+NOISE_SPREAD = 0.8
+NOISE_SPREAD_STEPS = 4 # noise travels further per turn than scent
+NOISE_DECAY = 0.7
+NOISE_THRESHOLD = 0.05
+
+#########################
+## Auto-explore/Travel ##
+#########################
+
+TRAVEL_MAX_STEPS = 1000 # hard stop for one travel/explore command
+TRAVEL_DIRECTIONS = ((0, -1), (0, 1), (-1, 0), (1, 0)) # same 4 moves as the arrow keys
+MONSTER_DIRECTIONS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)) # monsters can go diagonal
+
 ##################################
 ## Foundational Classes        ###
 ##################################
@@ -118,7 +283,7 @@ class Rect:
 class Object:
     # catch-all object class. Player, monsters, item, everything will be a character on-screen.
 
-    def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None):
+    def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None, light=None, equipment=None, layer=None):
         self.always_visible = always_visible
 
         self.x = x
@@ -151,6 +316,29 @@ class Object:
         if self.item: # let item component know who owns it
             self.item.owner = self
 
+        # Light
+        self.light = light
+        if self.light: # let light component know who owns it
+            self.light.owner = self
+
+        # Equipment - always an item too, so it can be picked up and used (equipped)
+        self.equipment = equipment
+        if self.equipment:
+            self.equipment.owner = self
+            if not self.item:
+                self.item = Item()
+                self.item.owner = self
+
+        # what it's drawn over/under. Fighters stand on top of items, items on top of floor stuff
+        if layer is None:
+            if self.fighter:
+                layer = LAYER_ACTORS
+            elif self.item:
+                layer = LAYER_ITEMS
+            else:
+                layer = LAYER_DECALS
+        self.layer = layer
+
     def move(self,dx,dy):
         # move by a delta, unless destination is blocked
         if not is_blocked(self.x + dx, self.y + dy):
@@ -207,11 +395,28 @@ class Object:
         # return distance to any coordinates
         return math.sqrt((x - self.x) ** 2 + (y - self.y) ** 2)
 
-    def send_to_back(self):
-        # make this object be drawn first, so that others appear above it if on same tile
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
+    def clone(self, x, y):
+        # copy of this object at a new spot, with its own copies of its components. Used to stamp out monsters and items from spawn prototypes
+        obj = copy.copy(self)
+        obj.x = x
+        obj.y = y
+
+        if self.fighter:
+            obj.fighter = copy.copy(self.fighter)
+            obj.fighter.owner = obj
+        if self.ai:
+            obj.ai = copy.copy(self.ai)
+            obj.ai.owner = obj
+        if self.item:
+            obj.item = copy.copy(self.item)
+            obj.item.owner = obj
+        if self.light:
+            obj.light = copy.copy(self.light)
+            obj.light.owner = obj
+        if self.equipment:
+            obj.equipment = copy.copy(self.equipment)
+            obj.equipment.owner = obj
+        return obj
 
 #####################
 ### Components   #####
@@ -224,9 +429,11 @@ class Item:
         self.use_function = use_function
 
     def use(self):
-        # just call "use_function" if defined
-        if self.use_function is None:
-            message('The ' + self.owner.name + ' cannot be used.')
+        # equipment gets put on / taken off, everything else calls "use_function" if defined
+        if self.owner.equipment:
+            self.owner.equipment.toggle_equip()
+        elif self.use_function is None:
+            log_event('cannot_use', target=self.owner.name)
         elif self.use_function() != 'cancelled':
             inventory.remove(self.owner) #destroy item after use, unless cancelled
         # else:
@@ -235,43 +442,129 @@ class Item:
     def pick_up(self):
         # add to player inventory, remove from  map.
         if len(inventory) >= 26:
-            message('Your inventory is full, cannot pick up ' + self.owner.name + '.', tcod.red)
+            log_event('inventory_full', tcod.red, target=self.owner.name)
         else:
             inventory.append(self.owner)
-            objects.remove(self.owner)
-            message("Picked up a " + self.owner.name + "!", tcod.green)
+            remove_object(self.owner)
+            log_event('pick_up', tcod.green, target=self.owner.name)
+            publish('item_picked_up', item=self.owner)
 
     def drop(self):
-        # add to map, remove from inventory
-        objects.append(self.owner)
+        # add to map, remove from inventory. Take it off first, if it's being worn
+        if self.owner.equipment:
+            self.owner.equipment.dequip()
+        add_object(self.owner)
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
-        message('You dropped a ' + self.owner.name + '.', tcod.yellow)
+        log_event('drop', tcod.yellow, target=self.owner.name)
+
+
+class Light:
+    # a light source. Static lights (braziers) get baked into the level's light map once, the rest (torch, glowing monsters) are redone every frame
+    def __init__(self, radius, color, static=False):
+        self.radius = radius
+        self.color = color
+        self.static = static
+
 
+class Equipment:
+    # something that can be wielded or worn. While it's equipped, its bonuses count towards the player's stats
+    def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
+        self.slot = slot
+        self.power_bonus = power_bonus
+        self.defense_bonus = defense_bonus
+        self.max_hp_bonus = max_hp_bonus
+        self.is_equipped = False
+
+    def toggle_equip(self):
+        if self.is_equipped:
+            self.dequip()
+        else:
+            self.equip()
+
+    def equip(self):
+        # one thing per slot - whatever's there already comes off
+        old_equipment = get_equipped_in_slot(self.slot)
+        if old_equipment is not None:
+            old_equipment.dequip()
+
+        self.is_equipped = True
+        player.fighter.add_bonus(self)
+        log_event('equip', tcod.light_green, target=self.owner.name, text=self.slot)
+
+    def dequip(self):
+        if not self.is_equipped:
+            return
+        self.is_equipped = False
+        player.fighter.remove_bonus(self)
+        log_event('dequip', tcod.light_yellow, target=self.owner.name, text=self.slot)
+
+def get_equipped_in_slot(slot):
+    for bonus in player.fighter.bonuses:
+        if isinstance(bonus, Equipment) and bonus.slot == slot:
+            return bonus
+    return None
 
 class Fighter:
     # combat related properties and methods (monster, player, NPC)
+    # power, defense and max_hp are base stats + every bonus (equipment, modifiers) on top. The totals are cached, and
+    # only added up again after a bonus comes or goes or a base stat changes - attacks just read the cache
     def __init__(self, hp, defense, power, xp, death_function=None):
-        self.max_hp = hp
+        self.base_max_hp = hp
         self.hp = hp
-        self.defense = defense
-        self.power = power
+        self.base_defense = defense
+        self.base_power = power
         self.xp = xp
         self.death_function = death_function
+        self.bonuses = () # Equipment and StatModifiers counting towards the totals. A tuple, so snapshots can share it
+        self.totals = None # (max_hp, power, defense), None when it needs adding up again
+
+    def stat_totals(self):
+        if self.totals is None:
+            (max_hp, power, defense) = (self.base_max_hp, self.base_power, self.base_defense)
+            for bonus in self.bonuses:
+                max_hp += bonus.max_hp_bonus
+                power += bonus.power_bonus
+                defense += bonus.defense_bonus
+            self.totals = (max_hp, power, defense)
+        return self.totals
+
+    @property
+    def max_hp(self):
+        return self.stat_totals()[0]
+
+    @property
+    def power(self):
+        return self.stat_totals()[1]
+
+    @property
+    def defense(self):
+        return self.stat_totals()[2]
+
+    def raise_base(self, max_hp=0, power=0, defense=0):
+        self.base_max_hp += max_hp
+        self.base_power += power
+        self.base_defense += defense
+        self.totals = None
+
+    def add_bonus(self, bonus):
+        self.bonuses = self.bonuses + (bonus,)
+        self.totals = None
+
+    def remove_bonus(self, bonus):
+        self.bonuses = tuple(other for other in self.bonuses if other is not bonus)
+        self.totals = None
+        self.hp = min(self.hp, self.max_hp) # losing max HP can't leave us with more than the max
 
     def take_damage(self, damage):
-        # apply damage if possible
+        # apply damage if possible. What dying means (corpse, XP, game over) is up to whoever's listening
         if damage > 0:
             self.hp -= damage
+            publish('damage_dealt', target=self.owner, amount=damage)
 
-            # check for death. If there's a death function, call it!
             if self.hp <= 0:
-                df = self.death_function
-                if df is not None:
-                    df(self.owner)
-                if self.owner != player:
-                    player.fighter.xp += self.xp
+                publish('entity_died', entity=self.owner, fighter=self)
 
     def attack(self, target):
         # a simple formula for attack damage
@@ -280,16 +573,19 @@ class Fighter:
         # lazy random damage
         # damage = int(self.power * (tcod.random_get_int(0,75,125) / 100)) - target.fighter.defense
 
+        # fighting is loud
+        make_noise(self.owner.x, self.owner.y, NOISE_ATTACK)
+
         if damage > 0:
             if target.name == 'player':
                 text_color = tcod.red
             else:
                 text_color = tcod.green
             # make target take some damage
-            message(str(self.owner.name.capitalize()) + ' attacks ' + str(target.name) + ' for ' + str(damage) + ' HP!', text_color)
+            log_event('attack', text_color, self.owner.name, target.name, damage)
             target.fighter.take_damage(damage)
         else:
-            message(str(self.owner.name.capitalize()) + 'attacks ' + str(target.name) + ' but it has no effect!', tcod.white)
+            log_event('attack_no_effect', tcod.white, self.owner.name, target.name)
 
 
     def heal(self, amount):
@@ -307,12 +603,16 @@ class BasicMonster:
 
             # move towards player if far away
             if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+                move_along_path(monster, player.x, player.y)
 
             # close enough - attack time, if player alive!
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
 
+        else:
+            # can't see the player - sniff them out, or go see what the noise was
+            follow_senses(monster)
+
 class RangedMonster:
     # AI for ranged (reloading / charging) monster
     def __init__(self, attack_range=(2,4), ammo=0):
@@ -329,6 +629,7 @@ class RangedMonster:
 
         if tcod.map_is_in_fov(fov_grid, monster.x, monster.y):
             # if in FoV
+            clear_shot = line_of_sight(monster.x, monster.y, player.x, player.y)
 
             # player far enough away? not maxed on ammo? reload
             if monster.distance_to(player) >= self.attack_range_avg and self.ammo < self.ammo_max:
@@ -338,47 +639,37 @@ class RangedMonster:
             if monster.distance_to(player) > self.attack_range[1] and self.ammo >= self.ammo_max:
                 monster.move_towards(player.x, player.y)
 
-            # player far enough away, got ammo? Fire
+            # player far enough away, got ammo? Fire - if nothing's in the way
             elif monster.distance_to(player) >= self.attack_range[0] and monster.distance_to(player) <= self.attack_range[1] and self.ammo == self.ammo_max and player.fighter.hp > 0:
-                self.ranged_attack()
+                if clear_shot:
+                    self.ranged_attack()
+                else:
+                    monster.move_towards(player.x, player.y)
 
 
             # too close - back up or fire if cornered!
             elif monster.distance_to(player) < self.attack_range[0] and player.fighter.hp > 0:
-                evade = monster.evade_vector(player.x, player.y)
+                evade = safe_retreat(monster)
 
                 if not evade:
                     if self.ammo < self.ammo_max:
                         self.stockpile()
-                    else:
+                    elif clear_shot:
                         self.ranged_attack()
                 else:
                     monster.move(evade[0],evade[1])
 
+        else:
+            follow_senses(monster)
+
     def stockpile(self):
         self.ammo += 1
-        message('The ' + self.owner.name + ' is loads its weapon!', tcod.red)
+        log_event('stockpile', tcod.red, self.owner.name)
 
     def ranged_attack(self):
         self.owner.fighter.attack(player)
         self.ammo -= 1
 
-class ConfusedMonster:
-    # AI for a confused monster
-
-    def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
-        self.old_ai = old_ai
-        self.num_turns = num_turns
-
-    def take_turn(self):
-        if self.num_turns > 0: #still confused...
-            #move in a random direction:
-            self.owner.move(tcod.random_get_int(0,-1,1), tcod.random_get_int(0,-1,1))
-            self.num_turns -= 1
-        else: #restore previous AI
-            self.owner.ai = self.old_ai
-            message('The ' + self.owner.name + ' is no longer confused!', tcod.red)
-
 class BossMonster:
     # AI for a heavy hitting boss monster
     def __init__(self):
@@ -393,11 +684,11 @@ class BossMonster:
             action_roll = tcod.random_get_int(0,0,100)
 
             if action_roll <= 20:
-                message(str(self.owner.name) + ' roars a challenge!', tcod.white)
+                log_event('roar', tcod.white, self.owner.name)
 
             else:
                 if action_roll > 70 and self.charged == 0:
-                    message(str(self.owner.name) + ' draws itself up to its full height!', tcod.white)
+                    log_event('charge', tcod.white, self.owner.name)
                     self.charged = 1
                     print("DEBUG LOG: DRAGON CHARGED = " + str(self.charged), tcod.white)
 
@@ -407,12 +698,15 @@ class BossMonster:
                         self.charged = 0
                 # move towards player if far away
                 elif monster.distance_to(player) >= 2:
-                    monster.move_towards(player.x, player.y)
+                    move_along_path(monster, player.x, player.y)
 
                 # close enough - attack time, if player alive!
                 elif player.fighter.hp > 0:
                         monster.fighter.attack(player)
 
+        else:
+            follow_senses(monster)
+
     def boss_action(self, target):
         # boss actions should really live under the fighter class, right? They're boss moves? but the AI logic fits better in the monster AI class...
 
@@ -420,7 +714,7 @@ class BossMonster:
 
         # Either way, dragons now rock you. Sweet.
         if self.owner.name == 'Dragon':
-            message(str(self.owner.name) + ' breathes fire!', tcod.white)
+            log_event('breathe_fire', tcod.white, self.owner.name)
             # dragons breathe fire. It's bad for ya.
             damage = self.owner.fighter.power + tcod.random_get_int(0,2,5) - target.fighter.defense
 
@@ -428,76 +722,235 @@ class BossMonster:
             text_color = tcod.orange
 
             # make target take some damage
-            message('** ' + str(self.owner.name.capitalize()) + ' attacks ' + str(target.name) + ' for ' + str(damage) + ' HP! **', text_color)
+            log_event('boss_attack', text_color, self.owner.name, target.name, damage)
             target.fighter.take_damage(damage)
 
 class ConfusedMonster:
-    # AI for temporarily confused monster
-    def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
+    # AI for temporarily confused monster. How long it lasts is up to the Confusion status effect, which swaps the old AI back in
+    def __init__(self, old_ai):
         self.old_ai = old_ai
-        self.num_turns = num_turns
 
     def take_turn(self):
-        if self.num_turns > 0: # still confused
-            # move in random direction, decrement turns left
-            self.owner.move(tcod.random_get_int(0, -1, 1), tcod.random_get_int(0,-1,1))
-            self.num_turns -= 1
-        else: #restore previous AI
-            self.owner.ai = self.old_ai
-            message('The ' + self.owner.name + ' is no longer confused!', tcod.red)
+        # move in random direction
+        self.owner.move(tcod.random_get_int(0, -1, 1), tcod.random_get_int(0,-1,1))
+
+#########################
+### Status Effects  #####
+#########################
+
+class StatusEffect:
+    # something that wears off after a number of turns. apply() runs when it starts, expire() when it runs out - nothing in between
+    def __init__(self, duration):
+        self.duration = duration
+        self.expires = None # turn it runs out, set by add_effect
+
+    def apply(self):
+        pass
+
+    def expire(self):
+        pass
+
+class StatModifier(StatusEffect):
+    # a temporary buff (or curse, with negative numbers) on a fighter's stats
+    def __init__(self, duration, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
+        StatusEffect.__init__(self, duration)
+        self.power_bonus = power_bonus
+        self.defense_bonus = defense_bonus
+        self.max_hp_bonus = max_hp_bonus
+
+    def apply(self):
+        self.owner.fighter.add_bonus(self)
+
+    def expire(self):
+        if self.owner.fighter: # unless it died in the meantime
+            self.owner.fighter.remove_bonus(self)
+
+class Confusion(StatusEffect):
+    def __init__(self, duration=CONFUSE_NUM_TURNS):
+        StatusEffect.__init__(self, duration)
+        self.old_ai = None
+
+    def apply(self):
+        # swap AI
+        monster = self.owner
+        self.old_ai = monster.ai
+        monster.ai = ConfusedMonster(self.old_ai)
+        monster.ai.owner = monster # don't forget, tell new component who owns it
+        log_event('confused', tcod.light_green, target=monster.name)
+
+    def expire(self):
+        #restore previous AI - unless it died in the meantime
+        monster = self.owner
+        if monster.fighter and isinstance(monster.ai, ConfusedMonster):
+            monster.ai = self.old_ai
+            log_event('unconfused', tcod.red, monster.name)
+
+class TimingWheel:
+    # effects filed into slots by the turn they expire. Each turn only that turn's slot is looked at, so the cost
+    # doesn't depend on how many effects are running
+    def __init__(self, size=EFFECT_WHEEL_SIZE):
+        self.slots = [[] for i in range(size)]
+
+    def schedule(self, effect):
+        self.slots[effect.expires % len(self.slots)].append(effect)
+
+    def advance(self, turn):
+        # expire everything due this turn. Effects more than a lap away stay put until their lap comes round
+        slot = self.slots[turn % len(self.slots)]
+        if not slot:
+            return
+
+        due = [effect for effect in slot if effect.expires <= turn]
+        if due:
+            slot[:] = [effect for effect in slot if effect.expires > turn]
+            for effect in due:
+                effect.expire()
+
+    def pending(self):
+        return [effect for slot in self.slots for effect in slot]
+
+    def clear(self):
+        for slot in self.slots:
+            del slot[:]
+
+status_effects = TimingWheel()
+
+def add_effect(target, effect):
+    effect.owner = target
+    effect.expires = turn + effect.duration
+    effect.apply()
+    status_effects.schedule(effect)
 
 ################
 ## Functions ###
 ################
 
+## Level contents ##
+
+# `objects` is everything on the level; render_layers is the same objects bucketed by layer, for render_all. Each bucket
+# is a dict used as an ordered set, so adding or removing one object is O(1). Anything that puts objects on the level or
+# takes them off goes through add_object/remove_object; replacing the whole list (new level, rewind, load) rebuilds it.
+
+render_layers = [{} for i in range(RENDER_LAYERS)]
+
+def add_object(obj):
+    objects.append(obj)
+    render_layers[obj.layer][obj] = None
+
+def remove_object(obj):
+    objects.remove(obj)
+    del render_layers[obj.layer][obj]
+
+def rebuild_render_layers():
+    global render_layers
+    render_layers = [{} for i in range(RENDER_LAYERS)]
+    for obj in objects:
+        render_layers[obj.layer][obj] = None
+
 ## Map construction ##
 
-def create_room(room):
-    global grid
+# Carving happens on blocked_map, a numpy bool array [x, y], so rooms and tunnels are slice assignments instead of
+# per-tile loops. The Tile grid is built from it in one go once the layout is done.
+
+blocked_map = np.ones((MAP_WIDTH, MAP_HEIGHT), dtype=bool)
+level_serial = 0 # new for every layout, so snapshots and caches can tell "same level" from "different level"
+last_level_serial = 0 # shared by every session, so a serial is never handed out twice - even after a rewind or a load
+rooms = [] # the current level's rooms, in the order they were dug
+level_stats = [] # one dict per generated level: dungeon_level, rerolls, repairs, ms
+
+def new_level_serial():
+    global last_level_serial
+    last_level_serial += 1
+    return last_level_serial
+
+def set_terrain(x, y, blocked):
+    # change one tile mid-level (a wall dug out, a door shut). That's a new layout as far as anything cached
+    # against the old one is concerned - FOV results, rewind history, routes - so it gets a new serial
+    global level_serial, fov_recompute
+
+    grid[x][y].blocked = blocked
+    grid[x][y].block_sight = blocked
+    blocked_map[x, y] = blocked
+    walkable_map[x, y] = not blocked
+    tcod.map_set_properties(fov_grid, x, y, not blocked, not blocked)
+
+    level_serial = new_level_serial()
+    build_room_graph()
+    bake_static_lights()
+    fov_recompute = True
 
-    # go through tiles in rectangle and make them passable
-    # note that range() will stop one short of the second argument, so that's the far boundary (room includes an outer wall).
+def create_room(room):
+    # make the tiles inside the rectangle passable
+    # note that slices stop one short of the end, so that's the far boundary (room includes an outer wall).
     # likewise, start from x1 + 1 to have a near wall too
-
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            grid[x][y].blocked = False
-            grid[x][y].block_sight = False
+    blocked_map[room.x1 + 1:room.x2, room.y1 + 1:room.y2] = False
 
 def create_h_tunnel(x1,x2,y):
-    global grid
     # horizontal tunnel
+    # oh, this is clever - always ensure the slice gets the smaller of x1 and x2 first
+    blocked_map[min(x1,x2):max(x1,x2)+1, y] = False
 
-    # oh, this is clever - always ensure the for loop gets the smaller of x1 and x2 first, to properly loop
+def create_v_tunnel(y1,y2,x):
+    # vertical tunnel
+    blocked_map[x, min(y1,y2):max(y1,y2)+1] = False
 
-    for x in range(min(x1,x2),max(x1,x2)+1):
-        grid[x][y].blocked = False
-        grid[x][y].block_sight = False
+def flood_fill(walkable, x, y):
+    # every walkable tile connected to (x, y), 4-way. Grows the whole region one step per pass, as arrays
+    reached = np.zeros_like(walkable)
+    reached[x, y] = True
 
-def create_v_tunnel(y1,y2,x):
-    global grid
+    while True:
+        grown = reached.copy()
+        grown[1:, :] |= reached[:-1, :]
+        grown[:-1, :] |= reached[1:, :]
+        grown[:, 1:] |= reached[:, :-1]
+        grown[:, :-1] |= reached[:, 1:]
+        grown &= walkable
+
+        if np.array_equal(grown, reached):
+            return reached
+        reached = grown
+
+def connect_regions(x, y):
+    # make sure every bit of floor can be reached from (x, y). Anything cut off gets a tunnel to the nearest reachable tile
+    # (rather than throwing the whole level away). returns how many tunnels that took
+    repairs = 0
 
-    # vertical tunnel
-    for y in range(min(y1,y2),max(y1,y2)+1):
-        grid[x][y].blocked = False
-        grid[x][y].block_sight = False
+    while True:
+        walkable = ~blocked_map
+        reached = flood_fill(walkable, x, y)
+        cut_off = np.argwhere(walkable & ~reached)
+
+        if cut_off.size == 0:
+            return repairs
+
+        (cx, cy) = cut_off[0]
+        reached_tiles = np.argwhere(reached)
+        (rx, ry) = reached_tiles[np.abs(reached_tiles - (cx, cy)).sum(axis=1).argmin()]
+
+        create_h_tunnel(cx, rx, cy)
+        create_v_tunnel(cy, ry, rx)
+        repairs += 1
 
 def make_grid():
     print("\n Attempting Grid generation.\n")
+    start_time = time.perf_counter()
+    clear_decals()
     grid_success = False
+    rerolls = 0
+    repairs = 0
 
     MAX_ROOMS = min( dungeon_level * 3 + 3 , 30)
     # MAX_ROOMS = 2
 
     while not grid_success:
-        global grid, objects, stairs # can't call this map, it's a named function
+        global grid, objects, stairs, level_serial, rooms # can't call this map, it's a named function
 
         objects = [player]
+        rebuild_render_layers()
         # fill map with "blocked" tiles - rooms will be carved out of rock, more or less
-
-        grid = [[Tile(True)
-                for y in range(MAP_HEIGHT)]
-                for x in range(MAP_WIDTH)]
+        blocked_map[:] = True
+        level_serial = new_level_serial()
 
         rooms = []
         num_rooms = 0
@@ -521,7 +974,6 @@ def make_grid():
             for other_room in rooms:
                 if new_room.intersect(other_room):
                     failed = True
-                    print("\n\nBlocked.\n\n")
                     break
                     # wow this is sloppy - if any room overlaps...what, skip? Yep
 
@@ -533,10 +985,6 @@ def make_grid():
 
                 # center coordinates are handy
                 (new_x, new_y) = new_room.center()
-                print((new_x, new_y))
-                print(x, y, w, h)
-                print(rooms)
-                print('\n\n')
 
                 if num_rooms == 0:
                     # first room! Place the player here
@@ -563,85 +1011,85 @@ def make_grid():
                         # create_h_tunnel(prev_x, new_x, prev_y)
                         create_h_tunnel(prev_x, new_x, new_y)
 
-                #add some contents to this room, such as monsters
-                place_objects(new_room)
-
                 # Append new room to the list
                 rooms.append(new_room)
                 num_rooms += 1
 
-        # create stairs at center of last OPEN room center. Iterate backwards through list. No possible placement? Reroll the dungeon.
+        # every floor tile reachable from the start? patch it up if not
+        repairs += connect_regions(player.x, player.y)
 
-        room = len(rooms) - 1
+        # carving's done - now build the actual tiles
+        grid = [[Tile(blocked) for blocked in column] for column in blocked_map.tolist()]
 
-        while True:
-            x, y = rooms[room].center()
+        for room in rooms:
+            #add some contents to this room, such as monsters
+            place_objects(room)
+
+            # maybe light the room with a brazier, tucked into a corner
+            if random.randint(1, 100) <= BRAZIER_CHANCE:
+                brazier = Object(room.x1 + 1, room.y1 + 1, '*', 'brazier', tcod.orange, always_visible=True, light=Light(BRAZIER_RADIUS, BRAZIER_COLOR, static=True))
+                add_object(brazier)
+
+        # create stairs at center of last OPEN room center. Iterate backwards through list.
+        # Every center taken? Any free spot in the last room will do. Only reroll the dungeon if even that fails.
+        spots = [room.center() for room in reversed(rooms)]
+        last = rooms[-1]
+        spots += [(x, y) for x in range(last.x1 + 1, last.x2) for y in range(last.y1 + 1, last.y2)]
+
+        for (x, y) in spots:
             if not is_blocked(x,y):
 
                 stairs = Object(x, y, '<', 'stairs', tcod.white, always_visible=True)
-                objects.append(stairs)
-                stairs.send_to_back() # draw below monsters
+                add_object(stairs) # floor layer - drawn below monsters
                 grid_success = True
-                print("Complete:" + str((x,y)) + " and " + str(is_blocked(x,y)))
                 break
 
-            room -= 1
+        if not grid_success:
+            rerolls += 1
 
-            if room <= -1:
-                grid_success = False
-                rooms = []
-                break
+    # keep the room layout around for pathfinding
+    build_room_graph()
+
+    stats = {'dungeon_level': dungeon_level, 'rerolls': rerolls, 'repairs': repairs, 'ms': (time.perf_counter() - start_time) * 1000}
+    level_stats.append(stats)
+    print('Level ' + str(dungeon_level) + ' generated in ' + str(round(stats['ms'], 1)) + ' ms (' + str(rerolls) + ' rerolls, ' + str(repairs) + ' repairs)')
+
+def install_level(level):
+    # use a level dug somewhere else (see generate_level) instead of digging one here
+    global grid, objects, stairs, level_serial, rooms
+
+    level_serial = new_level_serial()
+    clear_decals()
+    blocked_map[:] = level['blocked']
+    rooms = level['rooms']
+    grid = [[Tile(blocked) for blocked in column] for column in blocked_map.tolist()]
+    objects = [player] + level['objects']
+    rebuild_render_layers()
+    stairs = level['stairs']
+    (player.x, player.y) = level['start']
+    build_room_graph()
+    level_stats.append(level['stats'])
 
 def render_all():
-    global fov_grid, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
     global fov_recompute
 
     if fov_recompute:
         # recompute FOV if player moved, tile changed, etc
         fov_recompute = False
-        tcod.map_compute_fov(fov_grid, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        # set all tiles' background color - now, include FOV too
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-
-                visible = tcod.map_is_in_fov(fov_grid, x, y)
-
+        update_fov()
 
+    # set all tiles' background color - lights + FOV, in one go
+    paint_map()
+    paint_decals()
 
-                wall = grid[x][y].block_sight
-
-                if not visible:
-                    # if it's not visible right now, player can only see it if it's explored
-                    if grid[x][y].explored:
-
-                        # tile is OUT of player's FOV
-                        if wall:
-                            tcod.console_set_char_background(con, x, y,color_dark_wall, tcod.BKGND_SET)
-                        else:
-                            tcod.console_set_char_background(con, x, y, color_dark_ground, tcod.BKGND_SET)
-
-                else:
-                    # tile is IN of player's FOV
-                    if wall:
-                        tcod.console_set_char_background(con, x, y,color_light_wall, tcod.BKGND_SET)
-                    else:
-                        tcod.console_set_char_background(con, x, y, color_light_ground, tcod.BKGND_SET)
-
-                    # I think this makes sense here? See it = Explored it
-                    grid[x][y].explored = True
-
-    # # draw all objects in the list
-    for object in objects:
-        if object != player:
+    # # draw all objects, one layer at a time from the bottom up
+    for layer in render_layers:
+        for object in layer:
             object.draw()
-    player.draw()
-
-
-    #blit the contents of "con" to the root console and present it
-    tcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
 
+    if target_cursor is not None:
+        (x, y) = target_cursor
+        con.bg[y, x] = CURSOR_COLOR
 
     # prepare to render the GUI panel
     tcod.console_set_default_background(panel, tcod.black)
@@ -651,7 +1099,7 @@ def render_all():
     # print game messages, one line at a time
 
     y = 1
-    for (line, color) in game_msgs:
+    for (line, color) in recent_message_lines(MSG_HEIGHT):
         tcod.console_set_default_foreground(panel, color)
         tcod.console_print_ex(panel, MSG_X, y, tcod.BKGND_NONE, tcod.LEFT, line)
         y += 1
@@ -669,91 +1117,601 @@ def render_all():
     tcod.console_print_ex(panel, 1, 0, tcod.BKGND_NONE, tcod.LEFT, get_names_under_mouse())
 
 
-    # blit console of panel
-    tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, PANEL_Y)
 
 
+# FOV results are remembered per (layout, position, radius), bit-packed, so walking back over the same tiles doesn't
+# recompute anything. level_serial changes with any terrain change (set_terrain), which is what invalidates them.
+fov_cache = OrderedDict() # (level_serial, x, y, radius) -> np.packbits of the [y, x] fov mask, oldest first
+fov_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
 
+def compute_fov(x, y, radius):
+    # fill fov_grid's FOV from (x, y) - from the cache if we've been here before
+    key = (level_serial, x, y, radius)
+    packed = fov_cache.get(key)
 
-def place_objects(room):
-    # choose a random number of monsters
+    if packed is not None:
+        fov_cache.move_to_end(key)
+        fov_cache_stats['hits'] += 1
+        fov_grid.fov[:] = np.unpackbits(packed, count=MAP_WIDTH * MAP_HEIGHT).reshape(MAP_HEIGHT, MAP_WIDTH)
+        return
 
-    MAX_ROOM_MONSTERS = dungeon_level // 3 + 2
-    MAX_ROOM_ITEMS = dungeon_level // 4 + 1
-    MAX_ODDS = min(dungeon_level * 5 + 40, 100)
+    fov_cache_stats['misses'] += 1
+    tcod.map_compute_fov(fov_grid, x, y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
 
+    packed = np.packbits(fov_grid.fov)
+    fov_cache[key] = packed
+    fov_cache_stats['bytes'] += packed.nbytes
+    while fov_cache_stats['bytes'] > FOV_CACHE_BYTES:
+        (old_key, old) = fov_cache.popitem(last=False)
+        fov_cache_stats['bytes'] -= old.nbytes
 
-    ## Monsters
+def update_fov():
+    # compute FOV from the player's spot, and mark everything seen as explored. See it = Explored it
+    # returns how many tiles were explored for the first time (travel uses this to know the map changed)
+    compute_fov(player.x, player.y, TORCH_RADIUS)
 
-    num_monsters = tcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+    visible = fov_grid.fov.T # FOV arrays are [y, x], grid is [x][y]
+    newly_explored = visible & ~explored_map
 
-    monster_chances = {'orc': 35, 'archer': 10, 'troll': 20, 'dragon': 15, 'maw': 8, 'lich': 7, 'titan': 5}
-    item_chances = {'heal': 45, 'confuse': 20, 'fireball': 20, 'lightning': 20}
+    for (x, y) in zip(*np.nonzero(newly_explored)):
+        grid[x][y].explored = True
+    explored_map[newly_explored] = True
 
-    for i in range(num_monsters):
-        #choose random spot for this monster
-        x = tcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+    return int(np.count_nonzero(newly_explored))
 
-        if not is_blocked(x,y):
-            # monster_roll = tcod.random_get_int(0,0,100)
-            choice = random_choice(monster_chances, MAX_ODDS)
+################
+## Lighting ####
+################
+
+# Light is an rgb array over the whole map, 0 (dark) to 1 (fully lit) per channel.
+# Static lights only change when the level does, so they're added up once in bake_static_lights().
+# Every frame, paint_map() adds the moving lights + any spell flashes on top, then colors every tile in one numpy pass.
+
+TILE_XS, TILE_YS = np.indices((MAP_WIDTH, MAP_HEIGHT)) # [x, y] coordinates of every tile, for distance math
 
-            if choice == 'orc':
+explored_map = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=bool) # mirrors Tile.explored
+static_light_map = np.zeros((MAP_WIDTH, MAP_HEIGHT, 3), dtype=np.float32)
+dark_colors = np.zeros((MAP_WIDTH, MAP_HEIGHT, 3), dtype=np.float32) # what each tile looks like unlit...
+light_colors = np.zeros((MAP_WIDTH, MAP_HEIGHT, 3), dtype=np.float32) # ...and fully lit
+light_fov_grid = None # scratch FOV map for working out what each light reaches
+flashes = [] # (x, y, radius, color) spell flashes, shown for one frame
 
-                fighter_component = Fighter(hp=10, defense=0,power=3, xp=35, death_function=monster_death)
-                ai_component = BasicMonster()
+def light_reach(x, y, radius):
+    # tiles a light at (x, y) can reach - its own FOV, on a scratch map so the player's FOV is untouched
+    tcod.map_compute_fov(light_fov_grid, x, y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
+    return light_fov_grid.fov.T
 
-                monster = Object(x, y, 'o', 'Orc', tcod.desaturated_green, blocks=True, fighter=fighter_component, ai=ai_component)
+def light_contribution(x, y, radius, color, reach=None):
+    # rgb light thrown onto the map by one source, fading out linearly to nothing just past its radius
+    if reach is None:
+        reach = light_reach(x, y, radius)
 
-            elif choice == 'archer':
+    falloff = np.clip(1 - np.hypot(TILE_XS - x, TILE_YS - y) / (radius + 1), 0, 1) * reach
+    return falloff[..., np.newaxis] * (np.array(color, dtype=np.float32) / 255)
 
-                fighter_component = Fighter(hp=8, defense=0, power=3, xp = 35, death_function=monster_death)
-                ai_component = RangedMonster(attack_range=(2,4),ammo=1)
+def bake_static_lights():
+    # per-level setup: explored mask, tile colors, and the static light map. Call after fov_grid is built for a new level
+    global light_fov_grid
 
-                monster = Object(x,y, 'a', 'Goblin Archer', tcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
+    explored_map[:] = [[tile.explored for tile in column] for column in grid]
 
-            elif choice == 'troll':
-                # 23% chance - otherwise, it's a troll
+    wall = ~fov_grid.transparent.T[..., np.newaxis]
+    dark_colors[:] = np.where(wall, np.array(color_dark_wall), np.array(color_dark_ground))
+    light_colors[:] = np.where(wall, np.array(color_light_wall), np.array(color_light_ground))
 
-                fighter_component = Fighter(hp=16, defense=1,power=4, xp = 120, death_function=monster_death)
-                ai_component = BasicMonster()
+    light_fov_grid = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+    light_fov_grid.transparent[:] = fov_grid.transparent
 
-                monster = Object(x,y, 'T', 'Troll', tcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
+    static_light_map[:] = 0
+    for obj in objects:
+        if obj.light and obj.light.static:
+            static_light_map[:] += light_contribution(obj.x, obj.y, obj.light.radius, obj.light.color)
 
+def flash(x, y, radius, color):
+    # brief burst of light (spells), shown the next time the map is painted
+    flashes.append((x, y, radius, color))
 
-            elif choice == 'dragon':
-                # 7% chance of Dragon, it will rock you
-                fighter_component = Fighter(hp=30, defense=2,power=4, xp=500, death_function=monster_death)
-                ai_component = BossMonster()
+def dynamic_light_map():
+    # everything that moves or blinks - recomputed every frame
+    light = np.zeros((MAP_WIDTH, MAP_HEIGHT, 3), dtype=np.float32)
 
-                monster = Object(x, y, 'D', 'Dragon', tcod.red, blocks=True, fighter=fighter_component, ai=ai_component)
+    for obj in objects:
+        if obj.light and not obj.light.static:
+            if obj == player:
+                # the torch lights exactly what the player sees, which we already have
+                light += light_contribution(obj.x, obj.y, obj.light.radius, obj.light.color, fov_grid.fov.T)
+            elif player.distance_to(obj) <= TORCH_RADIUS + obj.light.radius:
+                # too far away to light anything the player could see? skip it
+                light += light_contribution(obj.x, obj.y, obj.light.radius, obj.light.color)
+
+    for (x, y, radius, color) in flashes:
+        light += light_contribution(x, y, radius, color)
+    del flashes[:]
+
+    return light
+
+def paint_map():
+    # color every tile's background: lit tiles blend dark -> light by how much light is on them, explored-but-unseen tiles are dark, unexplored are black
+    visible = fov_grid.fov.T[..., np.newaxis]
+
+    light = np.clip(static_light_map + dynamic_light_map(), 0, 1)
+    light = np.maximum(light, VISIBLE_MIN_LIGHT)
+
+    lit = dark_colors + (light_colors - dark_colors) * light
+    colors = np.where(visible, lit, np.where(explored_map[..., np.newaxis], dark_colors, 0))
+
+    con.bg[:MAP_HEIGHT, :MAP_WIDTH] = colors.transpose(1, 0, 2).astype(np.uint8)
+
+#######################
+## Decals #############
+#######################
+
+# Corpses used to stay in `objects` forever, so every scan of it (blocking, AI, drawing, mouse-over) kept paying for
+# every monster that ever died on the level. Now dying takes a monster out of `objects` and paints it onto the decal
+# layer instead: a glyph and color per tile, plus a name for the mouse-over. Decals can decay, via the timing wheel.
+
+decal_chars = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=np.int32) # 0 = nothing here
+decal_colors = np.zeros((MAP_WIDTH, MAP_HEIGHT, 3), dtype=np.uint8)
+decals = {} # (x, y) -> (name, turn it decays or None)
+decals_drawn = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=bool) # what paint_decals put on con last frame
+
+class Decay(StatusEffect):
+    # wears a decal away
+    def __init__(self, x, y, duration=CORPSE_DECAY_TURNS):
+        StatusEffect.__init__(self, duration)
+        (self.x, self.y) = (x, y)
+        self.level_serial = level_serial
+
+    def expire(self):
+        # only if it's still the same decal - the level might have changed, or something newer died here since
+        decal = decals.get((self.x, self.y))
+        if self.level_serial == level_serial and decal is not None and decal[1] == self.expires:
+            remove_decal(self.x, self.y)
+
+def add_decal(x, y, char, color, name, decay=None):
+    # paint something onto the floor. decay: turns until it's gone, None for never
+    expires = None
+    if decay is not None:
+        effect = Decay(x, y, decay)
+        add_effect(None, effect)
+        expires = effect.expires
+
+    decal_chars[x, y] = ord(char)
+    decal_colors[x, y] = color
+    decals[(x, y)] = (name, expires)
+
+def remove_decal(x, y):
+    decal_chars[x, y] = 0
+    del decals[(x, y)]
+
+def clear_decals():
+    decal_chars[:] = 0
+    decals.clear()
+
+def paint_decals():
+    # decals in view get drawn, and anything drawn last frame that's not (out of view, decayed, rewound away) gets
+    # wiped - straight into the console arrays
+    global decals_drawn
+
+    if not decals and not decals_drawn.any():
+        return
+
+    shown = (decal_chars != 0) & fov_grid.fov.T
+    chars = con.ch[:MAP_HEIGHT, :MAP_WIDTH]
+
+    chars[(decals_drawn & ~shown).T] = ord(' ')
+    decals_drawn = shown
+    shown = shown.T
+    chars[shown] = decal_chars.T[shown]
+    con.fg[:MAP_HEIGHT, :MAP_WIDTH][shown] = decal_colors.transpose(1, 0, 2)[shown]
+
+def decal_name(x, y):
+    # what's painted here, if the player can see it
+    decal = decals.get((x, y))
+    if decal is not None and tcod.map_is_in_fov(fov_grid, x, y):
+        return decal[0]
+    return None
 
-            elif choice == 'maw':
-                # needs abilities that debuff and constrict, hits real hard
-                # very aggressive AI
-                fighter_component = Fighter(hp=50, defense=4,power=8, xp=1000, death_function=monster_death)
-                ai_component = BasicMonster()
+#######################
+## Room Graph #########
+#######################
+
+# Every level is rooms joined by corridors, so paths are found in two steps:
+# - coarse: Dijkstra over a graph of regions (each room, and each stretch of corridor between rooms). Hundreds of rooms
+#   is still a tiny graph, and routes get cached for the level
+# - fine: breadth-first search on tiles, but only inside the region we're in and the next one on the route
+# So a long path never searches the whole map, and a monster only ever needs the first fine step.
+
+region_map = np.full((MAP_WIDTH, MAP_HEIGHT), -1, dtype=np.int32) # region id per tile: rooms first, then corridors. -1 = wall
+region_centers = [] # (x, y) per region, for edge weights
+region_edges = [] # set of neighbouring region ids, per region
+route_cache = {} # (start region, goal region) -> list of regions
+
+def build_room_graph():
+    # work out the regions and which ones touch. Call whenever the level's layout changes
+    global region_centers, region_edges
+
+    region_map[:] = -1
+    centers = []
+    for (i, room) in enumerate(rooms):
+        region_map[room.x1 + 1:room.x2, room.y1 + 1:room.y2] = i
+        centers.append(room.center())
+
+    # whatever floor is left over is corridor - split it into connected stretches
+    corridor = ~blocked_map & (region_map == -1)
+    for (x, y) in zip(*np.nonzero(corridor)):
+        if region_map[x, y] != -1:
+            continue
+
+        region = len(centers)
+        region_map[x, y] = region
+        cells = [(x, y)]
+        frontier = deque(cells)
+        while frontier:
+            (cx, cy) = frontier.popleft()
+            for (dx, dy) in TRAVEL_DIRECTIONS:
+                (nx, ny) = (cx + dx, cy + dy)
+                if corridor[nx, ny] and region_map[nx, ny] == -1:
+                    region_map[nx, ny] = region
+                    cells.append((nx, ny))
+                    frontier.append((nx, ny))
+
+        (xs, ys) = zip(*cells)
+        centers.append((sum(xs) / len(cells), sum(ys) / len(cells)))
+
+    # two regions are joined wherever their tiles sit side by side
+    edges = [set() for center in centers]
+    for (a, b) in ((region_map[:-1, :], region_map[1:, :]), (region_map[:, :-1], region_map[:, 1:])):
+        touching = (a >= 0) & (b >= 0) & (a != b)
+        for (ra, rb) in set(zip(a[touching].tolist(), b[touching].tolist())):
+            edges[ra].add(rb)
+            edges[rb].add(ra)
+
+    region_centers = centers
+    region_edges = edges
+    route_cache.clear()
+
+def coarse_route(start, goal, allowed=None):
+    # cheapest list of regions from start to goal (both included), or None. allowed limits which regions can be used
+    key = (start, goal)
+    if allowed is None and key in route_cache:
+        return route_cache[key]
+
+    came_from = {start: None}
+    cost = {start: 0}
+    frontier = [(0, start)]
+
+    while frontier:
+        (here_cost, here) = heapq.heappop(frontier)
+        if here == goal:
+            break
+        if here_cost > cost[here]:
+            continue
+
+        (hx, hy) = region_centers[here]
+        for neighbour in region_edges[here]:
+            if allowed is not None and neighbour not in allowed:
+                continue
+            (nx, ny) = region_centers[neighbour]
+            new_cost = here_cost + math.hypot(nx - hx, ny - hy)
+            if neighbour not in cost or new_cost < cost[neighbour]:
+                cost[neighbour] = new_cost
+                came_from[neighbour] = here
+                heapq.heappush(frontier, (new_cost, neighbour))
+
+    route = None
+    if goal in came_from:
+        route = [goal]
+        while route[-1] != start:
+            route.append(came_from[route[-1]])
+        route.reverse()
+
+    if allowed is None:
+        route_cache[key] = route
+    return route
+
+def local_path(x, y, regions, is_goal, directions, explored_only):
+    # breadth-first search on tiles, but only through the given regions. Returns the tiles after (x, y) up to the
+    # first goal tile, or None
+    parents = {(x, y): None}
+    frontier = deque([(x, y)])
+
+    while frontier:
+        cell = frontier.popleft()
+        if is_goal(cell):
+            path = []
+            while cell != (x, y):
+                path.append(cell)
+                cell = parents[cell]
+            path.reverse()
+            return path
+
+        for (dx, dy) in directions:
+            (nx, ny) = (cell[0] + dx, cell[1] + dy)
+            if (nx, ny) not in parents and region_map[nx, ny] in regions and (explored_map[nx, ny] or not explored_only):
+                parents[(nx, ny)] = cell
+                frontier.append((nx, ny))
+    return None
 
-                monster = Object(x, y, 'M', 'Maw', tcod.red, blocks=True, fighter=fighter_component, ai=ai_component)
+def find_path(x, y, target_x, target_y, directions=MONSTER_DIRECTIONS, explored_only=False, max_segments=None):
+    # tiles to walk from (x, y) to the target (not including where we start), or None if there's no way.
+    # Terrain only - monsters in the way are the caller's problem. max_segments=1 just gets us into the next region
+    start = region_map[x, y]
+    goal = region_map[target_x, target_y]
+    if start < 0 or goal < 0:
+        return None
 
-            elif choice == 'lich':
-                # will have spells that summon badguys - lich can be fragile-ish
-                # should have debuffs, evasive AI
-                fighter_component = Fighter(hp=70, defense=4, power=12, xp=1500, death_function=monster_death)
-                ai_component = BasicMonster()
+    allowed = None
+    if explored_only:
+        # only route through regions the player has actually seen some of
+        allowed = set(np.unique(region_map[explored_map]).tolist())
 
-                monster = Object(x, y, 'L', 'Lich', tcod.black, blocks=True, fighter=fighter_component, ai=ai_component)
+    route = coarse_route(start, goal, allowed)
+    if route is None:
+        return None
 
-            elif choice == 'titan':
-                # will have spells that summon badguys - lich can be fragile-ish
-                # should have debuffs, evasive AI
-                fighter_component = Fighter(hp=300, defense=10, power=25, xp=10000, death_function=monster_death)
-                ai_component = BasicMonster()
+    path = deque()
+    for (i, region) in enumerate(route):
+        if max_segments is not None and i >= max_segments:
+            break
+
+        if i == len(route) - 1:
+            # last region - straight to the target
+            segment = local_path(x, y, (region,), lambda cell: cell == (target_x, target_y), directions, explored_only)
+        else:
+            # just far enough to get into the next region
+            next_region = route[i + 1]
+            segment = local_path(x, y, (region, next_region), lambda cell: region_map[cell] == next_region, directions, explored_only)
 
-                monster = Object(x, y, 'T', 'Titan', tcod.white, blocks=True, fighter=fighter_component, ai=ai_component)
+        if segment is None:
+            return None
+        path.extend(segment)
+        if segment:
+            (x, y) = segment[-1]
+    return path
+
+def move_along_path(monster, target_x, target_y):
+    # take the first step of a proper path, or just head straight there if there isn't one (or it's blocked)
+    path = find_path(monster.x, monster.y, target_x, target_y, max_segments=1)
+
+    if path:
+        (x, y) = path[0]
+        if not is_blocked(x, y):
+            monster.move(x - monster.x, y - monster.y)
+            return
+    monster.move_towards(target_x, target_y)
+
+####################
+## Line of Sight ###
+####################
+
+# Ranged attackers ask "can I see the player?" and "where do I back off to?" - answers get memoized for the rest of
+# the turn, so a room full of archers doesn't redo the same ray walks and searches.
+
+turn_cache_key = None # (level_serial, turn, player.x, player.y) the caches below were filled for
+los_cache = {} # (x0, y0, x1, y1) -> True/False
+retreat_distances = None # distance of every floor tile from the player, 8-way
+
+def check_turn_cache():
+    # throw the memos away when the turn (or level, or where the player stands) changes
+    global turn_cache_key, retreat_distances
+
+    key = (level_serial, turn, player.x, player.y)
+    if key != turn_cache_key:
+        turn_cache_key = key
+        los_cache.clear()
+        retreat_distances = None
+
+def bresenham(x0, y0, x1, y1):
+    # tiles on the line between two points, both ends included
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx + dy
 
-            objects.append(monster)
+    while True:
+        yield (x0, y0)
+        if x0 == x1 and y0 == y1:
+            return
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+def line_of_sight(x0, y0, x1, y1):
+    # True if nothing opaque sits between the two tiles (the ends themselves don't count)
+    check_turn_cache()
+
+    key = (x0, y0, x1, y1)
+    if key not in los_cache:
+        transparent = fov_grid.transparent # [y, x]
+        clear = True
+        for (x, y) in bresenham(x0, y0, x1, y1):
+            if (x, y) != (x0, y0) and (x, y) != (x1, y1) and not transparent[y, x]:
+                clear = False
+                break
+        los_cache[key] = clear
+    return los_cache[key]
+
+def safe_retreat(monster):
+    # the step that gets the monster furthest (by walking distance) from the player, or None if it's cornered.
+    # The distances are worked out once per turn and shared by every monster that wants to back off
+    global retreat_distances
+    check_turn_cache()
+
+    if retreat_distances is None:
+        retreat_distances = distance_map([(player.x, player.y)], MONSTER_DIRECTIONS, explored_only=False)
+
+    best = retreat_distances[monster.x][monster.y]
+    if best is None:
+        return None
+
+    step = None
+    for (dx, dy) in MONSTER_DIRECTIONS:
+        d = retreat_distances[monster.x + dx][monster.y + dy]
+        if d is not None and d > best and not is_blocked(monster.x + dx, monster.y + dy):
+            best = d
+            step = (dx, dy)
+    return step
+
+################
+## Senses ######
+################
+
+# Scent and noise are float arrays over the map. The player and fights put values in, then once a turn
+# spread_field() smears them into neighbouring floor and fades them - one numpy stencil for the whole level.
+# Monsters that can't see the player just look at the tiles around them and head for the strongest smell/sound,
+# so there's no per-monster search at all.
+
+scent_map = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=np.float32)
+noise_map = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=np.float32)
+walkable_map = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=np.float32) # 1 = floor, 0 = wall. Scent/noise don't go through walls
+
+def reset_senses():
+    # new level, clean slate. Call after fov_grid is built
+    scent_map[:] = 0
+    noise_map[:] = 0
+    walkable_map[:] = fov_grid.walkable.T
+
+def make_noise(x, y, amount):
+    noise_map[x, y] += amount
+
+def spread_field(field, spread, decay):
+    # each tile keeps (1 - spread) of what it had and gets spread/4 of each of its 4 neighbours. Walls soak it up
+    padded = np.pad(field, 1)
+    neighbours = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+    field[:] = ((1 - spread) * field + spread * neighbours / 4) * decay * walkable_map
+
+def update_senses():
+    # once per turn, before the monsters move
+    scent_map[player.x, player.y] = max(scent_map[player.x, player.y], SCENT_STRENGTH)
+    spread_field(scent_map, SCENT_SPREAD, SCENT_DECAY)
+
+    for i in range(NOISE_SPREAD_STEPS):
+        spread_field(noise_map, NOISE_SPREAD, NOISE_DECAY ** (1 / NOISE_SPREAD_STEPS))
+
+def follow_senses(monster):
+    # step onto whichever neighbouring tile smells (or, failing that, sounds) strongest, if it's stronger than here.
+    # returns True if the monster moved
+    for (field, threshold) in ((scent_map, SCENT_THRESHOLD), (noise_map, NOISE_THRESHOLD)):
+        best = max(field[monster.x, monster.y], threshold)
+        step = None
+
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                value = field[monster.x + dx, monster.y + dy]
+                if value > best and not is_blocked(monster.x + dx, monster.y + dy):
+                    best = value
+                    step = (dx, dy)
+
+        if step is not None:
+            monster.move(step[0], step[1])
+            return True
+    return False
+
+class SpawnTable:
+    # spawn chances for one dungeon level, compiled down to a cumulative array so picking is a binary search instead of a walk through the dict
+    def __init__(self, entries, max_odds):
+        self.max_odds = max_odds
+        self.cumulative = []
+        self.prototypes = []
+
+        running_sum = 0
+        for (chance, prototype) in entries:
+            # entries that start past max_odds can never be rolled on this level, so leave them out
+            if running_sum >= max_odds:
+                break
+            running_sum += chance
+            self.cumulative.append(running_sum)
+            self.prototypes.append(prototype)
+
+    def choose(self):
+        # same odds as random_choice: roll 0..max_odds, first entry whose running sum covers the dice wins
+        dice = random.randint(0, self.max_odds)
+        index = bisect.bisect_left(self.cumulative, dice)
+        if index == len(self.prototypes):
+            return None
+        return self.prototypes[index]
+
+def load_spawn_prototypes():
+    # read monster/item definitions from SPAWN_FILE and build one prototype Object for each, along with its spawn chance
+    global spawn_prototypes
+
+    with open(SPAWN_FILE) as f:
+        data = json.load(f)
+
+    monsters = []
+    for entry in data['monsters']:
+        ai_args = dict(entry.get('ai_args', {}))
+        if 'attack_range' in ai_args:
+            ai_args['attack_range'] = tuple(ai_args['attack_range'])
+
+        fighter_component = Fighter(hp=entry['hp'], defense=entry['defense'], power=entry['power'], xp=entry['xp'], death_function=monster_death)
+        ai_component = globals()[entry['ai']](**ai_args)
+
+        light_component = None
+        if 'light' in entry:
+            light_component = Light(entry['light']['radius'], getattr(tcod, entry['light']['color']))
+
+        monster = Object(0, 0, entry['char'], entry['label'], getattr(tcod, entry['color']), blocks=True, fighter=fighter_component, ai=ai_component, light=light_component)
+        monsters.append((entry['chance'], monster))
+
+    items = {'items': [], 'rare_items': []}
+    for kind in items:
+        for entry in data.get(kind, []):
+            # equipment gets used by putting it on, everything else names its use function
+            equipment_component = None
+            if 'equipment' in entry:
+                equipment_component = Equipment(**entry['equipment'])
+                item_component = Item()
+            else:
+                item_component = Item(use_function=globals()[entry['use']])
+            item = Object(0, 0, entry['char'], entry['label'], getattr(tcod, entry['color']), item=item_component, equipment=equipment_component, always_visible=True)
+            items[kind].append((entry['chance'], item))
+
+    spawn_prototypes = {'monsters': monsters, 'items': items['items'], 'rare_items': items['rare_items']}
+
+spawn_prototypes = None
+spawn_tables = {} # dungeon_level -> (monster table, item table, rare item table)
+
+def get_spawn_tables(level):
+    # compile the spawn tables once per dungeon level, reuse them for every room after that
+    if spawn_prototypes is None:
+        load_spawn_prototypes()
+
+    if level not in spawn_tables:
+        max_odds = min(level * 5 + 40, 100)
+        # rare items (equipment and the like) get one roll per room out of RARE_ITEM_ODDS, on every level - their own
+        # table, so they don't change the odds of anything else
+        spawn_tables[level] = (SpawnTable(spawn_prototypes['monsters'], max_odds), SpawnTable(spawn_prototypes['items'], max_odds),
+            SpawnTable(spawn_prototypes['rare_items'], RARE_ITEM_ODDS))
+    return spawn_tables[level]
+
+def place_objects(room):
+    # choose a random number of monsters
+
+    MAX_ROOM_MONSTERS = dungeon_level // 3 + 2
+    MAX_ROOM_ITEMS = dungeon_level // 4 + 1
+
+    (monster_table, item_table, rare_item_table) = get_spawn_tables(dungeon_level)
+
+    ## Monsters
+
+    num_monsters = tcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+
+    for i in range(num_monsters):
+        #choose random spot for this monster
+        x = tcod.random_get_int(0, room.x1+1, room.x2-1)
+        y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+
+        if not is_blocked(x,y):
+            prototype = monster_table.choose()
+            if prototype is not None:
+                add_object(prototype.clone(x, y))
 
     num_items = tcod.random_get_int(0,0, MAX_ROOM_ITEMS)
 
@@ -764,32 +1722,17 @@ def place_objects(room):
 
         # only place if space not blocked
         if not is_blocked(x,y):
+            prototype = item_table.choose()
+            if prototype is not None:
+                item = prototype.clone(x, y)
+                add_object(item) # item layer - rendered behind monsters
 
-            choice = random_choice(item_chances, MAX_ODDS)
-
-            if choice == 'heal':
-                # create healing potion
-                item_component = Item(use_function=cast_heal)
-                item = Object(x,y, '!', 'healing potion', tcod.violet, item=item_component, always_visible=True)
-
-            elif choice == 'confuse':
-                # confuse scroll
-                item_component = Item(use_function=cast_confuse)
-                item = Object(x,y, '#', 'confuse scroll', tcod.light_yellow, item=item_component, always_visible=True)
-
-            elif choice == 'lightning':
-                # lightning scroll
-                item_component = Item(use_function=cast_lightning)
-                item = Object(x,y, '#', 'lightning scroll', tcod.light_yellow, item=item_component, always_visible=True)
-
-
-            elif choice == 'fireball':
-                # fireball scroll
-                item_component = Item(use_function = cast_fireball)
-                item = Object(x,y, '#', 'fireball scroll', tcod.light_yellow, item=item_component, always_visible=True)
-
-            objects.append(item)
-            item.send_to_back() # items are rendered behind other objects
+    prototype = rare_item_table.choose()
+    if prototype is not None:
+        x = tcod.random_get_int(0, room.x1+1, room.x2-1)
+        y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+        if not is_blocked(x,y):
+            add_object(prototype.clone(x, y))
 
 def is_blocked(x,y):
     # test the map tile
@@ -817,24 +1760,83 @@ def closest_monster(max_range):
                 closest_enemy = object
     return closest_enemy
 
-def target_tile(max_range=None):
+preset_target = None # a tile chosen before target_tile was called - the server sets this, since it can't wait for a click
+target_cursor = None # (x, y) of the keyboard targeting cursor while there is one - render_all highlights it
+
+# no mouse (terminal renderers, the server): targeting is a cursor the arrows move around
+CURSOR_MOVES = {tcod.KEY_UP: (0, -1), tcod.KEY_DOWN: (0, 1), tcod.KEY_LEFT: (-1, 0), tcod.KEY_RIGHT: (1, 0)}
+CURSOR_COLOR = (255, 255, 255)
+
+def targetable(x, y, max_range=None, explored_ok=False):
+    # could the player pick this tile? In FOV (or already seen, with explored_ok) and in range
+    in_view = tcod.map_is_in_fov(fov_grid, x, y) or (explored_ok and 0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT and grid[x][y].explored)
+    return in_view and (max_range is None or player.distance(x,y) <= max_range)
+
+def target_tile(max_range=None, explored_ok=False):
     # return position of a tile left-clicked by the player in FOV,
     # or(None, None if right-clicked)
-    global key, mouse
-    while True:
-        # render screen, that'll erase the menu and show names of objects under the mouse.
-        tcod.console_flush()
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS|tcod.EVENT_MOUSE,key,mouse)
-        render_all()
+    # explored_ok lets the player click anywhere they've already seen (travel), not just in FOV
+    global key, mouse, preset_target
+
+    if preset_target is not None:
+        # already picked, before anything asked (network play). Asked again - target_monster does that when there's
+        # nobody on the tile - and it's cancelled
+        (x, y) = preset_target
+        preset_target = (None, None)
+        if x is not None and targetable(x, y, max_range, explored_ok):
+            return (x, y)
+        return (None, None)
+
+    if not renderer.has_mouse:
+        return cursor_tile(max_range, explored_ok)
+
+    # render screen, that'll erase the menu and show names of objects under the mouse.
+    present()
+
+    while not renderer.closed():
+        if not wait_for_input():
+            continue # nothing happened - no need to draw the same screen again
 
         (x, y) = (mouse.cx, mouse.cy)
 
-        if mouse.lbutton_pressed and tcod.map_is_in_fov(fov_grid, x, y) and (max_range is None or player.distance(x,y) <= max_range):
+        if mouse.lbutton_pressed and targetable(x, y, max_range, explored_ok):
             return (x,y)
 
         if mouse.rbutton_pressed or key.vk == tcod.KEY_ESCAPE:
             return (None, None) # cancel!
 
+        # mouse moved - update the names under it
+        present()
+
+    return (None, None)
+
+def cursor_tile(max_range=None, explored_ok=False):
+    # target_tile with the keyboard: arrows move a cursor (starting on the player), Enter or '.' picks the tile under
+    # it, ESC cancels
+    global target_cursor
+
+    (x, y) = (player.x, player.y)
+    try:
+        while not renderer.closed():
+            target_cursor = (x, y)
+            (mouse.cx, mouse.cy) = (x, y) # the panel names whatever's under the cursor
+            present()
+
+            while not wait_for_input() & tcod.EVENT_KEY_PRESS:
+                if renderer.closed():
+                    return (None, None)
+
+            if key.vk in CURSOR_MOVES:
+                (dx, dy) = CURSOR_MOVES[key.vk]
+                (x, y) = (min(max(x + dx, 0), MAP_WIDTH - 1), min(max(y + dy, 0), MAP_HEIGHT - 1))
+            elif key.vk == tcod.KEY_ENTER or (key.vk == tcod.KEY_CHAR and chr(key.c) == '.'):
+                if targetable(x, y, max_range, explored_ok):
+                    return (x, y)
+            elif key.vk == tcod.KEY_ESCAPE:
+                return (None, None) # cancel!
+        return (None, None)
+    finally:
+        target_cursor = None
 
 def target_monster(max_range=None):
     # returns a clicked monster in FOV up to a range, or None if right clicked
@@ -849,7 +1851,8 @@ def target_monster(max_range=None):
             if obj.x == x and obj.y == y and obj.fighter and obj != player:
                 return obj
 
-def next_level():
+def next_level(level=None):
+    # level: one that's already been dug (by generate_level), otherwise dig one now
     global dungeon_level
     # advance to next level
     message('You take a moment to rest, recovering your strength.', tcod.light_violet)
@@ -860,33 +1863,58 @@ def next_level():
     # new level time
     dungeon_level += 1
 
-    make_grid()
+    if level is None and BEST_OF > 1:
+        level = generate_best_level(dungeon_level, random.getrandbits(32))
+
+    if level is None:
+        make_grid()
+    else:
+        install_level(level)
 
     initialize_fov()
 
+    take_snapshot()
+    publish('level_entered', dungeon_level=dungeon_level)
+
+def level_up_due():
+    # see if player's xp is enough to level up
+    return player.fighter.xp >= LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
+
+def level_up_options():
+    return ['Constitution (+20 HP), from ' + str(player.fighter.max_hp) + ')', 'Strength (+1 attack, from ' + str(player.fighter.power) + ')', 'Agility (+1 defense, from ' + str(player.fighter.defense) + ')']
+
+def level_up(choice):
+    # level, raising the stat picked from level_up_options
+    global level_up_ready
+
+    player.fighter.xp -= LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
+    player.level += 1
+    log_event('level_up', tcod.yellow, amount=player.level)
 
+    if choice == 0:
+        player.fighter.raise_base(max_hp=20)
+        player.fighter.hp += 20
+    elif choice == 1:
+        player.fighter.raise_base(power=1)
+    elif choice == 2:
+        player.fighter.raise_base(defense=1)
+
+    level_up_ready = level_up_due() # enough XP for another one?
 
 def check_level_up():
-    # see if player's xp is enough to level up
-    level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
-    if player.fighter.xp >= level_up_xp:
+    # only looks at XP once an xp_gained event has said there might be enough
+    if level_up_ready:
         # it is, level
-        player.level += 1
-        player.fighter.xp -= level_up_xp
-        message('Your battle skills grow stronger! You reached level ' + str(player.level) + '!', tcod.yellow)
-
         choice = None
         while choice == None:
+            if renderer.closed():
+                return False # nobody left to choose - it'll be asked again if they come back
             # player picks benefit
-            choice = menu('Level up! Choose a stat to raise:\n', ['Constitution (+20 HP), from ' + str(player.fighter.max_hp) + ')', 'Strength (+1 attack, from ' + str(player.fighter.power) + ')', 'Agility (+1 defense, from ' + str(player.fighter.defense) + ')'], LEVEL_SCREEN_WIDTH)
+            choice = menu('Level up! Choose a stat to raise:\n', level_up_options(), LEVEL_SCREEN_WIDTH)
 
-        if choice == 0:
-            player.fighter.max_hp += 20
-            player.fighter.hp += 20
-        elif choice == 1:
-            player.fighter.power += 1
-        elif choice == 2:
-            player.fighter.defense += 1
+        level_up(choice)
+        return True # leveled up
+    return False
 
 
 def random_choice(chances_dict, MAX_ODDS):
@@ -976,6 +2004,153 @@ def player_move_or_attack(dx, dy):
         player.move(dx,dy)
         fov_recompute = True
 
+################################
+#### Auto-explore / Travel #####
+################################
+
+# Walking a long explored corridor one keypress (and one render + flush) per tile is slow.
+# These commands build a distance map over the explored map, then walk downhill on it in a tight
+# loop - monsters still get their turns every step, but nothing is drawn until we stop.
+
+def distance_map(goals, directions=TRAVEL_DIRECTIONS, explored_only=True):
+    # breadth-first distance from every explored, walkable tile to the nearest goal tile.
+    # None means unreachable (or unexplored - we only ever path through what the player has seen)
+    # monsters know the map, so they pass explored_only=False
+    dist = [[None for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH)]
+    frontier = deque()
+
+    for (x, y) in goals:
+        dist[x][y] = 0
+        frontier.append((x, y))
+
+    while frontier:
+        (x, y) = frontier.popleft()
+        next_dist = dist[x][y] + 1
+
+        for (dx, dy) in directions:
+            nx = x + dx
+            ny = y + dy
+            if 0 <= nx < MAP_WIDTH and 0 <= ny < MAP_HEIGHT and dist[nx][ny] is None:
+                tile = grid[nx][ny]
+                if (tile.explored or not explored_only) and not tile.blocked:
+                    dist[nx][ny] = next_dist
+                    frontier.append((nx, ny))
+    return dist
+
+def downhill_step(dist):
+    # the move from the player's tile that gets closest to a goal, or None if nothing is closer
+    best = dist[player.x][player.y]
+    step = None
+
+    for (dx, dy) in TRAVEL_DIRECTIONS:
+        d = dist[player.x + dx][player.y + dy]
+        if d is not None and d < best:
+            best = d
+            step = (dx, dy)
+    return step
+
+def explore_goals():
+    # explored floor tiles next to something we haven't seen yet - the edge of the known map
+    goals = []
+    for x in range(1, MAP_WIDTH - 1):
+        for y in range(1, MAP_HEIGHT - 1):
+            tile = grid[x][y]
+            if tile.explored and not tile.blocked:
+                for (dx, dy) in TRAVEL_DIRECTIONS:
+                    if not grid[x + dx][y + dy].explored:
+                        goals.append((x, y))
+                        break
+    return goals
+
+def stairs_goals():
+    # only once the player has actually found them
+    if grid[stairs.x][stairs.y].explored:
+        return [(stairs.x, stairs.y)]
+    return []
+
+def visible_monsters():
+    return [obj for obj in objects
+        if obj.fighter and obj != player and tcod.map_is_in_fov(fov_grid, obj.x, obj.y)]
+
+def item_under_player():
+    for obj in objects:
+        if obj.item and obj.x == player.x and obj.y == player.y:
+            return obj
+    return None
+
+def travel(goals_function, explore=False):
+    # walk towards the goals many turns at a time. Stops if a monster shows up, we take damage,
+    # we step onto an item, or there's nowhere left to go. The caller renders the final state once.
+    global fov_recompute
+
+    if visible_monsters():
+        message('Not with enemies in view!', tcod.red)
+        return
+
+    # one place to go? route it over the room graph - much cheaper than a distance map over the whole level.
+    # (falls back to the distance map if the known part of the map doesn't connect up room to room)
+    path = None
+    if not explore:
+        goals = goals_function()
+        if len(goals) == 1:
+            path = find_path(player.x, player.y, goals[0][0], goals[0][1], TRAVEL_DIRECTIONS, explored_only=True)
+
+    dist = None
+    for i in range(TRAVEL_MAX_STEPS):
+        if path is not None:
+            if not path:
+                return # arrived!
+            (x, y) = path.popleft()
+            step = (x - player.x, y - player.y)
+            if is_blocked(x, y):
+                return # something is in the way
+
+        elif dist is None:
+            goals = goals_function()
+            if not goals:
+                if explore:
+                    message('Nothing left to explore.', tcod.light_gray)
+                else:
+                    message("You don't know the way there.", tcod.light_gray)
+                return
+            dist = distance_map(goals)
+
+        if path is None:
+            here = dist[player.x][player.y]
+            if here is None:
+                message("You can't find a way there.", tcod.light_gray)
+                return
+
+            if here == 0:
+                if not explore:
+                    return # arrived!
+                dist = None # reached the edge of the map we know - look for the next one
+                continue
+
+            step = downhill_step(dist)
+            if step is None or is_blocked(player.x + step[0], player.y + step[1]):
+                return # something is in the way
+
+        hp_before = player.fighter.hp
+        player.move(step[0], step[1])
+        fov_recompute = True
+
+        # new tiles seen means the edge of the map moved - exploring needs a fresh distance map
+        if update_fov() and explore:
+            dist = None
+
+        take_monster_turns()
+
+        if game_state != 'playing' or player.fighter.hp < hp_before:
+            return
+        if visible_monsters():
+            message('You spot an enemy!', tcod.red)
+            return
+        item = item_under_player()
+        if item is not None:
+            log_event('item_here', tcod.light_gray, target=item.name)
+            return
+
 def player_death(player):
     # the game ended!
     global game_state
@@ -987,15 +2162,13 @@ def player_death(player):
     player.color = tcod.dark_red
 
 def monster_death(monster):
-    # make a monster corpse - doesn't attack, move, can't be hit
-    message(str(monster.name.capitalize()) + ' is dead! You gain ' + str(monster.fighter.xp) + ' XP!', tcod.yellow)
-    monster.char = '%'
-    monster.color = tcod.dark_red
-    monster.blocks = False
+    # leave a corpse on the decal layer - the monster itself is gone from the level
+    log_event('death', tcod.yellow, monster.name, amount=monster.fighter.xp)
     monster.fighter = None
     monster.ai = None
-    monster.name = 'remains of ' + str(monster.name)
-    monster.send_to_back()
+    monster.clear()
+    remove_object(monster)
+    add_decal(monster.x, monster.y, '%', CORPSE_COLOR, 'remains of ' + str(monster.name), CORPSE_DECAY_TURNS)
 
 
 def closest_monster(max_range):
@@ -1032,17 +2205,100 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     stats = str(name) + ': ' + str(value) + '/' + str(maximum)
     tcod.console_print_ex(panel, int(x + total_width / 2), y, tcod.BKGND_NONE, tcod.CENTER, stats)
 
-def message(new_msg, color = tcod.white):
-    # split message if necessary to multi-line (wordwrap)
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+class Event:
+    # one entry in the message log, kept as raw parts. Turned into wrapped text lines the first time something displays it
+    __slots__ = ('kind', 'color', 'actor', 'target', 'amount', 'text', 'lines')
+
+    def __init__(self, kind, color, actor=None, target=None, amount=None, text=None):
+        self.kind = kind
+        self.color = color
+        self.actor = actor
+        self.target = target
+        self.amount = amount
+        self.text = text
+        self.lines = None
+
+    def format_lines(self):
+        # list of (line, color), word-wrapped to the message area. Cached, so each event is only formatted once
+        if self.lines is None:
+            actor = self.actor or ''
+            text = EVENT_TEXT[self.kind].format(Actor=actor.capitalize(), actor=actor, target=self.target, amount=self.amount, text=self.text)
+            self.lines = [(line, self.color) for line in textwrap.wrap(text, MSG_WIDTH)]
+        return self.lines
+
+def log_event(kind, color=tcod.white, actor=None, target=None, amount=None, text=None):
+    # record that something happened. Cheap - no strings are built until the panel shows it
+    game_msgs.append(Event(kind, color, actor, target, amount, text))
+
+#################################
+## Event Bus ####################
+#################################
+
+# Things that happen in the game get published here, and whatever cares subscribes - so take_damage doesn't need to
+# know about corpses or XP, and nothing has to poll every frame to notice a change. Synchronous: every handler has
+# run by the time publish() returns.
+#   damage_dealt(target, amount), entity_died(entity, fighter), xp_gained(amount), item_picked_up(item),
+#   level_entered(dungeon_level)
+
+event_handlers = {} # kind -> handlers, in the order they subscribed
+level_up_ready = False # set when XP comes in and there's enough to level
+run_stats = {} # kind -> count/total, for the end-of-game report
 
-    for line in new_msg_lines:
-        # buffer full? Remove first line to make room for next one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+def subscribe(kind, handler):
+    event_handlers.setdefault(kind, []).append(handler)
 
-        # add the new line as a tuple, with the text and color
-        game_msgs.append( (line, color) )
+def unsubscribe(kind, handler):
+    event_handlers[kind].remove(handler)
+
+def publish(kind, **data):
+    for handler in event_handlers.get(kind, ()):
+        handler(**data)
+
+def on_entity_died(entity, fighter):
+    if fighter.death_function is not None:
+        fighter.death_function(entity)
+    if entity is not player:
+        publish('xp_gained', amount=fighter.xp)
+
+def on_xp_gained(amount):
+    global level_up_ready
+    player.fighter.xp += amount
+    level_up_ready = level_up_due()
+
+def on_level_entered(dungeon_level):
+    autosave()
+    memory_checkpoint()
+
+def count_stat(name, amount=1):
+    run_stats[name] = run_stats.get(name, 0) + amount
+
+def on_damage_dealt(target, amount):
+    count_stat('damage_taken' if target is player else 'damage_dealt', amount)
+
+subscribe('entity_died', on_entity_died)
+subscribe('xp_gained', on_xp_gained)
+subscribe('level_entered', on_level_entered)
+subscribe('damage_dealt', on_damage_dealt)
+subscribe('entity_died', lambda entity, fighter: count_stat('kills' if entity is not player else 'deaths'))
+subscribe('xp_gained', lambda amount: count_stat('xp', amount))
+subscribe('item_picked_up', lambda item: count_stat('items'))
+subscribe('level_entered', lambda dungeon_level: count_stat('levels'))
+
+def message(new_msg, color = tcod.white):
+    # plain text message
+    log_event('message', color, text=new_msg)
+
+def recent_message_lines(count):
+    # the newest lines that fit in count rows. Only the events that end up on screen get formatted
+    if not FORMAT_MESSAGES:
+        return []
+
+    lines = []
+    for event in reversed(game_msgs):
+        lines = event.format_lines() + lines
+        if len(lines) >= count:
+            break
+    return lines[-count:]
 
 def cast_heal():
     # heal the player
@@ -1055,6 +2311,11 @@ def cast_heal():
 
 
 
+def cast_strength():
+    # more power for a while - a StatModifier, taken off again by the timing wheel
+    message('You feel your muscles swell!', tcod.light_violet)
+    add_effect(player, StatModifier(STRENGTH_TURNS, power_bonus=STRENGTH_BONUS))
+
 def cast_lightning():
     # find closest enemy inside maximum range, damage it
     monster = closest_monster(LIGHTNING_RANGE)
@@ -1063,7 +2324,8 @@ def cast_lightning():
         return 'cancelled'
 
     # nuke it:
-    message('Lightning arcs to strike the ' + monster.name + ' with a deafening crash! The ' + monster.name + ' takes ' + str(LIGHTNING_DAMAGE) + ' damage.', tcod.light_blue)
+    log_event('lightning', tcod.light_blue, target=monster.name, amount=LIGHTNING_DAMAGE)
+    flash(monster.x, monster.y, 2, FLASH_COLOR_LIGHTNING)
     monster.fighter.take_damage(LIGHTNING_DAMAGE)
 
 
@@ -1076,11 +2338,7 @@ def cast_confuse():
         message ('No enemy close enough to target Confuse spell.')
         return 'cancelled'
 
-    # swap AI
-    old_ai = monster.ai
-    monster.ai = ConfusedMonster(old_ai)
-    monster.ai.owner = monster # don't forget, tell new component who owns it
-    message('The eyes of the ' + monster.name + ' glaze over. It starts to stumble around!', tcod.light_green)
+    add_effect(monster, Confusion())
 
 def cast_fireball():
     # ask player where to send the fireball
@@ -1090,10 +2348,11 @@ def cast_fireball():
         return 'cancelled'
 
     message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', tcod.orange)
+    flash(x, y, FIREBALL_RADIUS + 1, FLASH_COLOR_FIRE)
 
-    for obj in objects: # damage every fighter in range
+    for obj in list(objects): # damage every fighter in range (copy - the dead leave the list)
         if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
-            message('The ' + obj.name + 'was burned for ' + str(FIREBALL_DAMAGE) + ' HP.', tcod.orange)
+            log_event('burn', tcod.orange, target=obj.name, amount=FIREBALL_DAMAGE)
             obj.fighter.take_damage(FIREBALL_DAMAGE)
 
 # ######################################################################
@@ -1167,6 +2426,13 @@ def inventory_menu(header):
         return None
     return inventory[index].item
 
+USE_HEADER = 'Press key next to item to use, or any other to cancel.'
+DROP_HEADER = 'Press key next to any item to DROP that item, or any other to cancel.'
+
+def character_sheet():
+    level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
+    return 'Character Information \n\nLevel: ' + str(player.level) + '\nExperience: ' +  str(player.fighter.xp) + '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.fighter.max_hp) + '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense)
+
 def handle_keys():
 
     global fov_recompute, key
@@ -1224,13 +2490,13 @@ def handle_keys():
 
             elif key_char == 'i':
                 # show inventory
-                chosen_item = inventory_menu('Press key next to item to use, or any other to cancel.')
+                chosen_item = inventory_menu(USE_HEADER)
                 if chosen_item is not None:
                     chosen_item.use()
 
             elif key_char == 'd':
                 # show inventory, but for dropping:
-                chosen_item = inventory_menu('Press key next to any item to DROP that item, or any other to cancel.')
+                chosen_item = inventory_menu(DROP_HEADER)
                 if chosen_item is not None:
                     chosen_item.drop()
 
@@ -1241,12 +2507,31 @@ def handle_keys():
 
             elif key_char == 'c':
                 # show character sheet
-                level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
-                msgbox('Character Information \n\nLevel: ' + str(player.level) + '\nExperience: ' +  str(player.fighter.xp) + '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.fighter.max_hp) + '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
+                msgbox(character_sheet(), CHARACTER_SCREEN_WIDTH)
+            elif key_char == 'x':
+                # auto-explore
+                travel(explore_goals, explore=True)
+
+            elif key_char == '>':
+                # travel to the stairs, if found
+                travel(stairs_goals)
+
+            elif key_char == 't':
+                # travel to a clicked tile the player has already seen
+                message('Left-click a tile to travel there, ESC key or right-click to cancel.', tcod.cyan)
+                (x, y) = target_tile(explored_ok=True)
+                if x is not None:
+                    travel(lambda: [(x, y)])
+
+            elif key_char == 'u' and WIZARD_MODE:
+                # wizard mode: take back a turn
+                rewind(1)
+
             elif key_char == 'm':
                 for y in range(MAP_HEIGHT):
                     for x in range(MAP_WIDTH):
                         grid[x][y].explored = True
+                explored_map[:] = True
 
             # elif key_char == 'a':
             #     chosen_ability = ability_menu('Press key next to any ability to use it, or any other to cancel.')
@@ -1265,12 +2550,15 @@ def get_names_under_mouse():
     # create a list of those names, if they're in player's FOV
     names = [obj.name for obj in objects
         if obj.x == x and obj.y == y and tcod.map_is_in_fov(fov_grid, obj.x, obj.y)]
+    if 0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT and decal_name(x, y) is not None:
+        names.append(decal_name(x, y))
 
     # join list into string, comma separated
     names = ', '.join(names)
     return names.capitalize()
 
-def menu(header, options, width):
+def menu_window(header, options, width):
+    # the menu drawn on its own console, and where it goes on screen: (window, x, y, height)
     if len(options) > 26:
         raise ValueError('Cannot have a menu with more than 26 options.')
 
@@ -1300,13 +2588,18 @@ def menu(header, options, width):
     # v low menu screen
     x = int(SCREEN_WIDTH/2 - width/2)
     y = int(SCREEN_HEIGHT/2 - height/2)
-    tcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
-    # foreground, background transparency are last two params ^. Overlays the
+    return (window, x, y, height)
+
+def menu(header, options, width):
+    (window, x, y, height) = menu_window(header, options, width)
+    renderer.draw(window, x, y, width, height, 0.7)
+    # background transparency is the last param ^. Overlays the
     # menu!
 
     # present the menu, wait for keypress
-    tcod.console_flush()
-    key = tcod.console_wait_for_keypress(True)
+    renderer.flush()
+    key = renderer.wait_for_keypress()
+    note_input()
 
     # convert ASCII Code to an index, if it matches an option return it
     index = key.c - ord('a')
@@ -1317,14 +2610,22 @@ def menu(header, options, width):
     return None
 
 
-def inventory_menu(header):
-    # show a menu with each item of the inventory as an option
+def inventory_options():
+    # one line per item of the inventory, for the inventory menu
     if len(inventory) == 0:
-        options = ['Inventory is empty.']
-    else:
-        options = [item.name for item in inventory]
+        return ['Inventory is empty.']
 
-    index = menu(header, options, INVENTORY_WIDTH)
+    options = []
+    for item in inventory:
+        text = item.name
+        if item.equipment and item.equipment.is_equipped:
+            text = text + ' (on ' + item.equipment.slot + ')'
+        options.append(text)
+    return options
+
+def inventory_menu(header):
+    # show a menu with each item of the inventory as an option
+    index = menu(header, inventory_options(), INVENTORY_WIDTH)
 
     # if an item was chosen, return it
     if index is None or len(inventory) == 0:
@@ -1336,47 +2637,306 @@ def inventory_menu(header):
 # Initialization and Main Game Loop #########
 #############################################
 
-# Setup Font
-font_filename = 'arial10x10.png'
-tcod.console_set_custom_font(font_filename, tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD)
+# The window, consoles and images are only set up when something needs them, so importing this file (tools, bots, tests) doesn't open a window or load any art.
+
+con = None # map console
+panel = None # GUI panel console
+window_open = False
+images = {} # filename -> loaded tcod image, so nothing is decoded twice
+menu_background = None # main menu art + titles, drawn once
+
+def init_consoles():
+    # offscreen consoles don't need the window, so headless runs can still use them
+    global con, panel
+
+    if con is None:
+        con = tcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+        panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
 
-# Initialize screen, then buffer console
-title = 'Python 3 + Libtcod tutorial'
-tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, title, FULLSCREEN)
+def init_window():
+    # font + root console. Safe to call more than once
+    global window_open
 
-# Set FPS
-tcod.sys_set_fps(LIMIT_FPS)
+    if window_open:
+        return
+
+    tcod.console_set_custom_font(FONT_FILE, tcod.FONT_TYPE_GREYSCALE | tcod.FONT_LAYOUT_TCOD)
+    tcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, WINDOW_TITLE, FULLSCREEN)
+    # turn-based sleeps on input anyway, so an FPS cap would only ever delay showing the result of a keypress
+    tcod.sys_set_fps(0 if TURN_BASED else LIMIT_FPS)
+
+    init_consoles()
+    window_open = True
+
+def load_image(filename):
+    if filename not in images:
+        images[filename] = tcod.image_load(filename)
+    return images[filename]
+
+#################################
+## Renderers ####################
+#################################
 
-# buffer console
-con = tcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+# The game always draws into offscreen tcod consoles (con, panel, menu windows) - those work with or without a window.
+# A renderer is what gets them in front of the player, and where input comes from:
+# - TcodRenderer: the usual window
+# - AnsiRenderer: this terminal, redrawing only the cells that changed - playable over ssh, no window needed
+# - NullRenderer: nothing on screen, and a simple bot at the keys - for timing the engine, batch runs, and spectators
+# They all have: open(), close(), draw(console, x, y, width, height, bg_alpha), flush(), wait_for_input(key, mouse,
+# timeout_ms), wait_for_keypress(), closed(), `draws` (False if there's no point drawing anything) and `has_mouse`
+# (False: target_tile uses a keyboard cursor instead of clicks)
 
-panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+class TcodRenderer:
+    draws = True
+    has_mouse = True
 
+    def open(self):
+        init_window()
 
+    def close(self):
+        pass
 
-def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level
+    def draw(self, console, x, y, width, height, bg_alpha=1.0):
+        tcod.console_blit(console, 0, 0, width, height, 0, x, y, 1.0, bg_alpha)
+
+    def flush(self):
+        tcod.console_flush()
+
+    def wait_for_input(self, key, mouse, timeout_ms):
+        # sleep until SDL has an event queued (or the timeout passes), then read it into key/mouse
+        if timeout_ms:
+            tcod.lib.SDL_WaitEventTimeout(tcod.ffi.NULL, timeout_ms)
+        return tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
+
+    def wait_for_keypress(self):
+        return tcod.console_wait_for_keypress(True)
+
+    def closed(self):
+        return tcod.console_is_window_closed()
+
+def draw_cells(screen, console, x, y, width, height, bg_alpha=1.0):
+    # console_blit, but onto a screen of cells (CELL_DTYPE) instead of the root console
+    width = min(width, console.width, SCREEN_WIDTH - x)
+    height = min(height, console.height, SCREEN_HEIGHT - y)
+    region = screen[y:y + height, x:x + width]
+    region['ch'] = console.ch[:height, :width]
+    region['fg'] = console.fg[:height, :width]
+    region['bg'] = (console.bg[:height, :width] * bg_alpha + region['bg'] * (1 - bg_alpha)).astype(np.uint8)
+
+class AnsiRenderer:
+    # keeps its own copy of the screen, and a copy of what the terminal is showing - flush() sends the difference.
+    # No mouse, so targeting uses the keyboard cursor
+    draws = True
+    has_mouse = False
+
+    def __init__(self, infile=sys.stdin, outfile=sys.stdout):
+        self.infile = infile
+        self.outfile = outfile
+        self.screen = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), dtype=CELL_DTYPE)
+        self.shown = None # nothing on the terminal yet
+        self.keys = deque() # parsed but not handed out yet
+        self.pending = b'' # start of an escape sequence that hasn't all arrived
+        self.saved_mode = None
+        self.eof = False
+        self.bytes_sent = 0
+
+    def open(self):
+        init_consoles()
+        if self.saved_mode is None and self.infile.isatty():
+            import termios, tty # unix only - imported here so the window version still runs on windows
+            self.saved_mode = termios.tcgetattr(self.infile)
+            tty.setcbreak(self.infile) # keys as they're pressed, no echo
+        if sys.stdout is self.outfile:
+            sys.stdout = sys.stderr # debug prints would land in the middle of the screen - run with 2>somefile to keep them
+        self.outfile.write('\x1b[2J\x1b[?25l') # clear, hide cursor
+        self.outfile.flush()
+
+    def close(self):
+        if self.saved_mode is not None:
+            import termios
+            termios.tcsetattr(self.infile, termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+        sys.stdout = self.outfile
+        self.outfile.write('\x1b[0m\x1b[?25h\x1b[' + str(SCREEN_HEIGHT + 1) + ';1H')
+        self.outfile.flush()
+
+    def draw(self, console, x, y, width, height, bg_alpha=1.0):
+        draw_cells(self.screen, console, x, y, width, height, bg_alpha)
+
+    def flush(self):
+        cells = self.screen.ravel()
+        if self.shown is None:
+            changed = range(cells.size)
+        else:
+            changed = np.nonzero(cells != self.shown.ravel())[0].tolist()
+
+        out = [ansi_cell(index, cells[index]) for index in changed]
+        if out:
+            out.append('\x1b[0m')
+            data = ''.join(out)
+            self.outfile.write(data)
+            self.outfile.flush()
+            self.bytes_sent += len(data)
+        self.shown = self.screen.copy()
+
+    def read_keys(self, timeout):
+        # wait up to timeout seconds (None = forever) for something on stdin, and parse whatever's there
+        fd = self.infile.fileno()
+        while not self.keys and not self.eof:
+            wait = timeout
+            if self.pending == b'\x1b':
+                wait = ESCAPE_WAIT_MS / 1000 if timeout is None else min(timeout, ESCAPE_WAIT_MS / 1000)
+            (ready, writable, errors) = select.select([fd], [], [], wait)
+            if not ready:
+                if self.pending == b'\x1b':
+                    (keys, self.pending) = parse_keys(self.pending, flush=True) # nothing followed - it was ESC
+                    self.keys.extend(keys)
+                    continue
+                return
+            data = os.read(fd, 1024)
+            if not data:
+                self.eof = True
+                return
+            (keys, self.pending) = parse_keys(self.pending + data)
+            self.keys.extend(keys)
+
+    def wait_for_input(self, key, mouse, timeout_ms):
+        self.read_keys(timeout_ms / 1000)
+        if not self.keys:
+            return 0
+
+        pressed = self.keys.popleft()
+        (key.vk, key.c, key.lalt) = (pressed.vk, pressed.c, False)
+        return tcod.EVENT_KEY_PRESS
+
+    def wait_for_keypress(self):
+        self.read_keys(None)
+        if not self.keys:
+            return tcod.Key(vk=tcod.KEY_ESCAPE) # input's gone - back out of whatever's asking
+        return self.keys.popleft()
+
+    def closed(self):
+        return self.eof
+
+BOT_ARROWS = {step: vk for (vk, step) in CURSOR_MOVES.items()} # (dx, dy) -> the arrow key that takes that step
+
+class NullRenderer:
+    # no player on the other end: nothing's drawn, and the keys come from a bot that fights whatever it sees, picks up
+    # what it walks over, explores, and takes the stairs - until it's pressed `keys` keys or died
+    draws = False
+    has_mouse = False
+
+    def __init__(self, keys=BATCH_KEYS):
+        self.keys_left = keys
+
+    def open(self):
+        init_consoles()
+
+    def close(self):
+        pass
+
+    def draw(self, console, x, y, width, height, bg_alpha=1.0):
+        pass
+
+    def flush(self):
+        pass
+
+    def wait_for_input(self, key, mouse, timeout_ms):
+        if self.closed():
+            return 0
+        self.keys_left -= 1
+        (key.vk, key.c, key.lalt) = self.next_key()
+        return tcod.EVENT_KEY_PRESS
+
+    def next_key(self):
+        # (vk, c, lalt) for the bot's next move
+        monsters = visible_monsters()
+        if monsters:
+            # walk at (or into) the nearest one: along whichever axis it's further away on, the other axis if that's
+            # walled off, otherwise the first step of a path round whatever's in the way
+            target = min(monsters, key=player.distance_to)
+            (dx, dy) = (target.x - player.x, target.y - player.y)
+            steps = [((dx > 0) - (dx < 0), 0), (0, (dy > 0) - (dy < 0))]
+            if abs(dy) > abs(dx):
+                steps.reverse()
+            for (sx, sy) in steps:
+                (x, y) = (player.x + sx, player.y + sy)
+                if (sx, sy) != (0, 0) and ((x, y) == (target.x, target.y) or not is_blocked(x, y)):
+                    return (BOT_ARROWS[(sx, sy)], 0, False)
+
+            path = find_path(player.x, player.y, target.x, target.y, TRAVEL_DIRECTIONS)
+            if path:
+                (x, y) = path[0]
+                return (BOT_ARROWS[(x - player.x, y - player.y)], 0, False)
+
+            # no way to it at all - wander, so at least the turns go by
+            open_steps = [step for step in TRAVEL_DIRECTIONS if not is_blocked(player.x + step[0], player.y + step[1])]
+            if open_steps:
+                return (BOT_ARROWS[random.choice(open_steps)], 0, False)
+
+        if item_under_player() is not None:
+            char = 'g'
+        elif (player.x, player.y) == (stairs.x, stairs.y):
+            char = ','
+        elif explore_goals():
+            char = 'x'
+        else:
+            char = '>'
+        return (tcod.KEY_CHAR, ord(char), False)
+
+    def wait_for_keypress(self):
+        # menus: the first option - a new game from the main menu, the first stat on a level up
+        return tcod.Key(vk=tcod.KEY_CHAR, c=ord('a'))
+
+    def closed(self):
+        return self.keys_left <= 0 or game_state == 'dead'
+
+RENDERERS = {'tcod': TcodRenderer, 'ansi': AnsiRenderer, 'null': NullRenderer}
+renderer = TcodRenderer()
+
+
+
+def new_game(level=None):
+    # level: a first level that's already been dug (by generate_level), otherwise dig one now
+    global player, inventory, game_msgs, game_state, dungeon_level, turn, level_up_ready
+
+    init_consoles()
 
     # create object representing player
     fighter_component = Fighter(hp=30,defense=1,power=5, xp=0, death_function=player_death)
-    player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component)
+    player = Object(0, 0, '@', 'player', tcod.white, blocks=True, fighter=fighter_component, light=Light(TORCH_RADIUS, TORCH_COLOR), layer=LAYER_PLAYER)
 
     player.level = 1
 
     # draw the grid (the map)
     dungeon_level = 1
-    make_grid()
+    if level is None and BEST_OF > 1:
+        level = generate_best_level(dungeon_level, random.getrandbits(32))
+
+    if level is None:
+        make_grid()
+    else:
+        install_level(level)
 
     initialize_fov()
     game_state = 'playing'
+    level_up_ready = False
 
     # handle inventory
     inventory = []
 
     # message console
-    game_msgs = []
+    game_msgs = deque(maxlen=EVENT_LOG_SIZE)
     message('Welcome to hell, meatbag! No one has survived before, best of luck kiddo.', tcod.red)
 
+    # turn counter + rewind history
+    turn = 0
+    status_effects.clear()
+    snapshots.clear()
+    run_stats.clear()
+    take_snapshot()
+    publish('level_entered', dungeon_level=dungeon_level)
+
 def initialize_fov():
     global fov_recompute, fov_grid
 
@@ -1391,6 +2951,461 @@ def initialize_fov():
         for x in range(MAP_WIDTH):
             tcod.map_set_properties(fov_grid, x, y, not grid[x][y].block_sight, not grid[x][y].blocked)
 
+    bake_static_lights()
+    reset_senses()
+
+#################################
+## Snapshots / Rewind ###########
+#################################
+
+# A snapshot of the whole game is taken at the end of every turn, and we can rewind to any of the last SNAPSHOT_HISTORY.
+# Copies are cheap because almost everything is shared with the snapshot before it:
+# - map arrays are stored one column at a time as bytes, and a column that didn't change reuses the previous snapshot's bytes
+# - each object is stored as an immutable record (its attributes + its components' attributes), and an object that
+#   didn't change reuses the previous record
+# So a turn where three monsters moved costs three new records and a few columns, not a copy of the level.
+
+snapshots = deque(maxlen=SNAPSHOT_HISTORY)
+
+class Snapshot:
+    __slots__ = ('turn', 'level_serial', 'dungeon_level', 'game_state', 'player', 'stairs', 'objects', 'inventory', 'records',
+        'blocked', 'explored', 'scent', 'noise', 'msgs', 'effects', 'rooms', 'decal_chars', 'decal_colors', 'decals')
+
+def share_columns(array, previous):
+    # a [x, y] array as a tuple of per-column bytes, reusing the previous snapshot's bytes for columns that didn't change
+    columns = []
+    for x in range(array.shape[0]):
+        data = array[x].tobytes()
+        if previous is not None and previous[x] == data:
+            data = previous[x]
+        columns.append(data)
+    return tuple(columns)
+
+def unshare_columns(columns, dtype):
+    return np.frombuffer(b''.join(columns), dtype=dtype).reshape(len(columns), -1)
+
+def object_record(obj):
+    # everything about an object that can change, as nested tuples
+    components = []
+    for name in ('fighter', 'ai', 'item', 'light', 'equipment'):
+        component = getattr(obj, name)
+        if component:
+            components.append((component, tuple(vars(component).items())))
+    return (tuple(vars(obj).items()), tuple(components))
+
+def take_snapshot():
+    previous = snapshots[-1] if snapshots else None
+    same_level = previous is not None and previous.level_serial == level_serial
+
+    snapshot = Snapshot()
+    snapshot.turn = turn
+    snapshot.level_serial = level_serial
+    snapshot.dungeon_level = dungeon_level
+    snapshot.game_state = game_state
+    snapshot.player = player
+    snapshot.stairs = stairs
+    snapshot.objects = tuple(objects)
+    snapshot.inventory = tuple(inventory)
+    snapshot.msgs = tuple(game_msgs)
+    snapshot.rooms = rooms # never changes once the level is dug
+    snapshot.effects = tuple(status_effects.pending()) # effects don't change once started, so references are enough
+
+    snapshot.blocked = previous.blocked if same_level else share_columns(blocked_map, None)
+    snapshot.explored = share_columns(explored_map, previous.explored if same_level else None)
+    snapshot.scent = share_columns(scent_map, previous.scent if same_level else None)
+    snapshot.noise = share_columns(noise_map, previous.noise if same_level else None)
+    snapshot.decal_chars = share_columns(decal_chars, previous.decal_chars if same_level else None)
+    snapshot.decal_colors = share_columns(decal_colors, previous.decal_colors if same_level else None)
+    snapshot.decals = previous.decals if same_level and previous.decals == decals else dict(decals)
+
+    snapshot.records = {}
+    for obj in snapshot.objects + snapshot.inventory:
+        record = object_record(obj)
+        if previous is not None and previous.records.get(obj) == record:
+            record = previous.records[obj] # unchanged - share it
+        snapshot.records[obj] = record
+
+    snapshots.append(snapshot)
+
+def restore_snapshot(snapshot):
+    global grid, objects, inventory, game_msgs, player, stairs, dungeon_level, game_state, turn, level_serial, fov_recompute, rooms, level_up_ready
+
+    for (obj, (state, components)) in snapshot.records.items():
+        obj.__dict__.clear()
+        obj.__dict__.update(state)
+        for (component, component_state) in components:
+            component.__dict__.clear()
+            component.__dict__.update(component_state)
+
+    objects = list(snapshot.objects)
+    rebuild_render_layers()
+    inventory = list(snapshot.inventory)
+    game_msgs = deque(snapshot.msgs, maxlen=EVENT_LOG_SIZE)
+    player = snapshot.player
+    stairs = snapshot.stairs
+    dungeon_level = snapshot.dungeon_level
+    game_state = snapshot.game_state
+    turn = snapshot.turn
+    level_up_ready = level_up_due()
+
+    status_effects.clear()
+    for effect in snapshot.effects:
+        status_effects.schedule(effect)
+
+    explored = unshare_columns(snapshot.explored, bool)
+
+    if snapshot.level_serial == level_serial:
+        # same layout, only what's been explored can differ
+        for (x, y) in zip(*np.nonzero(explored != explored_map)):
+            grid[x][y].explored = bool(explored[x, y])
+    else:
+        # a different level - rebuild the tiles and everything derived from them
+        level_serial = snapshot.level_serial
+        blocked_map[:] = unshare_columns(snapshot.blocked, bool)
+        rooms = snapshot.rooms
+        build_room_graph()
+        grid = [[Tile(blocked) for blocked in column] for column in blocked_map.tolist()]
+        for (x, y) in zip(*np.nonzero(explored)):
+            grid[x][y].explored = True
+        initialize_fov()
+
+    explored_map[:] = explored
+    scent_map[:] = unshare_columns(snapshot.scent, np.float32)
+    noise_map[:] = unshare_columns(snapshot.noise, np.float32)
+    decal_chars[:] = unshare_columns(snapshot.decal_chars, np.int32)
+    decal_colors[:] = unshare_columns(snapshot.decal_colors, np.uint8).reshape(decal_colors.shape)
+    decals.clear()
+    decals.update(snapshot.decals)
+    fov_recompute = True
+
+def rewind(turns):
+    # go back up to `turns` turns. The snapshot we land on stays as the newest one
+    turns = min(turns, len(snapshots) - 1)
+    if turns <= 0:
+        message('Nothing to rewind.', tcod.light_gray)
+        return
+
+    for i in range(turns):
+        snapshots.pop()
+    restore_snapshot(snapshots[-1])
+    tcod.console_clear(con)
+
+#################################
+## Autosave #####################
+#################################
+
+# Saving never stops the game: the snapshot taken at the end of every turn is already a cheap, unchanging copy of the
+# game, so the main thread just hands the newest one to a saver thread. That thread pickles it, compresses it and
+# writes it to a temp file that's then swapped in over the old save, so a crash mid-write leaves the last good save.
+# Objects are pickled by reference (persistent ids), and their state comes from the snapshot's records - so the saver
+# never reads anything the game is still changing.
+
+class Autosaver:
+    def __init__(self, path=SAVE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = None # newest snapshot waiting to be written - a newer one just replaces it
+        self.busy = False
+        self.thread = None
+        self.stats = [] # one dict per save: turn, bytes, pickle_ms, write_ms, total_ms, handoff_ms
+        self.skipped = 0
+
+    def submit(self, snapshot):
+        # main thread: hand over a snapshot. Never waits longer than AUTOSAVE_MAX_BLOCK_MS
+        start = time.perf_counter()
+        if not self.lock.acquire(timeout=AUTOSAVE_MAX_BLOCK_MS / 1000):
+            self.skipped += 1
+            return False
+
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+                self.thread.start()
+            self.pending = (snapshot, start)
+            self.ready.notify()
+        finally:
+            self.lock.release()
+        return True
+
+    def run(self):
+        # saver thread: write whatever's pending, forever
+        while True:
+            with self.lock:
+                while self.pending is None:
+                    self.ready.wait()
+                ((snapshot, submitted), self.pending) = (self.pending, None)
+                self.busy = True
+
+            try:
+                self.write(snapshot, submitted)
+            except (OSError, pickle.PicklingError) as e:
+                print('Autosave failed: ' + str(e))
+            finally:
+                with self.lock:
+                    self.busy = False
+                    self.ready.notify_all()
+
+    def write(self, snapshot, submitted):
+        start = time.perf_counter()
+        data = zlib.compress(dump_snapshot(snapshot))
+        pickled = time.perf_counter()
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path) # atomic - readers see the old save or the new one, never half of one
+        done = time.perf_counter()
+
+        self.stats.append({'turn': snapshot.turn, 'bytes': len(data), 'pickle_ms': (pickled - start) * 1000,
+            'write_ms': (done - pickled) * 1000, 'total_ms': (done - submitted) * 1000})
+
+    def wait(self, timeout=AUTOSAVE_EXIT_WAIT):
+        # block until nothing is pending or in progress (or we give up). True if everything got written
+        with self.lock:
+            return self.ready.wait_for(lambda: self.pending is None and not self.busy, timeout)
+
+    def discard(self):
+        # the run is over for good - no save to continue from
+        self.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+autosaver = Autosaver()
+
+def dump_snapshot(snapshot):
+    # pickle a snapshot. Objects and components are written as references; restore_snapshot fills them in from the records
+    refs = {}
+    for (obj, (state, components)) in snapshot.records.items():
+        refs[id(obj)] = (len(refs), type(obj))
+        for (component, component_state) in components:
+            refs[id(component)] = (len(refs), type(component))
+
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda obj: refs.get(id(obj))
+    pickler.dump(snapshot)
+    return buffer.getvalue()
+
+def load_snapshot(data):
+    instances = {}
+
+    def persistent_load(ref):
+        (index, cls) = ref
+        if index not in instances:
+            instances[index] = cls.__new__(cls) # empty for now - restore_snapshot fills in its attributes
+        return instances[index]
+
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def autosave():
+    # hand the newest snapshot to the saver. Dead characters don't get saved
+    if autosaver is not None and game_state != 'dead' and snapshots:
+        autosaver.submit(snapshots[-1])
+
+def load_game(path=SAVE_FILE):
+    # pick up a saved run where it left off. False if there's nothing (usable) to load
+    global level_serial
+
+    try:
+        with open(path, 'rb') as f:
+            snapshot = load_snapshot(zlib.decompress(f.read()))
+    except (OSError, zlib.error, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        print('Could not load ' + path + ': ' + str(e))
+        return False
+
+    init_consoles()
+    # the save's serial came from another run - it could match a layout this one has cached FOV or routes for
+    snapshot.level_serial = new_level_serial()
+    level_serial = -1 # force restore_snapshot to rebuild the level
+    restore_snapshot(snapshot)
+    snapshots.clear()
+    snapshots.append(snapshot)
+    return True
+
+def autosave_report():
+    if autosaver is None or not autosaver.stats:
+        return None
+    stats = autosaver.stats
+    if not stats:
+        return None
+    totals = sorted(save['total_ms'] for save in stats)
+    return {'saves': len(stats), 'skipped': autosaver.skipped, 'bytes': stats[-1]['bytes'],
+        'average_ms': sum(totals) / len(totals), 'max_ms': totals[-1]}
+
+#################################
+## Memory Instrumentation #######
+#################################
+
+# With MEMORY_INSTRUMENTATION on (--memory), every level change does a full gc, counts live game instances and takes a
+# tracemalloc snapshot. Anything still alive that the game can't account for (current level, inventory, rewind
+# history, spawn prototypes) after a level change is a leak - the old level should be gone by then.
+
+memory_reports = [] # one dict per level change - per session, so growth and leaks are compared against this game's last level
+last_memory_snapshot = None
+
+AI_CLASSES = (BasicMonster, RangedMonster, ConfusedMonster, BossMonster)
+
+def count_instances():
+    counts = {'Tile': 0, 'Object': 0, 'Fighter': 0, 'AI': 0, 'Item': 0, 'Light': 0}
+
+    for obj in gc.get_objects():
+        if isinstance(obj, Tile):
+            counts['Tile'] += 1
+        elif isinstance(obj, Object):
+            counts['Object'] += 1
+        elif isinstance(obj, Fighter):
+            counts['Fighter'] += 1
+        elif isinstance(obj, AI_CLASSES):
+            counts['AI'] += 1
+        elif isinstance(obj, Item):
+            counts['Item'] += 1
+        elif isinstance(obj, Light):
+            counts['Light'] += 1
+    return counts
+
+def accounted_objects():
+    # every Object the game is legitimately holding on to right now, in any session
+    held = set()
+    for session in live_sessions:
+        held.update(session.get('objects') or ())
+        held.update(session.get('inventory') or ())
+        for snapshot in session.get('snapshots'):
+            held.update(snapshot.records)
+    if spawn_prototypes is not None:
+        held.update(obj for (chance, obj) in spawn_prototypes['monsters'] + spawn_prototypes['items'] + spawn_prototypes['rare_items'])
+    return held
+
+def memory_checkpoint():
+    global last_memory_snapshot
+
+    if not MEMORY_INSTRUMENTATION:
+        return
+
+    import tracemalloc # --memory only
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    gc.collect()
+    counts = count_instances()
+    memory_snapshot = tracemalloc.take_snapshot()
+    (current, peak) = tracemalloc.get_traced_memory()
+
+    report = {
+        'dungeon_level': dungeon_level,
+        'turn': turn,
+        'counts': counts,
+        'current_mb': current / 1024 / 1024,
+        'peak_mb': peak / 1024 / 1024,
+        'leaked_tiles': counts['Tile'] - MAP_WIDTH * MAP_HEIGHT * sum(1 for session in live_sessions if session.get('grid') is not None), # only each session's current grid should be alive
+        'leaked_objects': counts['Object'] - len(accounted_objects()),
+        'growth': [],
+    }
+
+    if last_memory_snapshot is not None:
+        for stat in memory_snapshot.compare_to(last_memory_snapshot, 'lineno')[:MEMORY_TOP_GROWTH]:
+            report['growth'].append(str(stat))
+    last_memory_snapshot = memory_snapshot
+
+    memory_reports.append(report)
+
+    print('Memory @ level ' + str(dungeon_level) + ': ' + str(round(report['current_mb'], 1)) + ' MB (peak ' + str(round(report['peak_mb'], 1)) + ' MB) ' + str(counts))
+    for line in report['growth']:
+        print('    ' + line)
+
+    # growth that survived the level change?
+    if report['leaked_tiles'] > 0 or report['leaked_objects'] > 0:
+        previous = memory_reports[-2] if len(memory_reports) > 1 else None
+        if previous is None or report['leaked_tiles'] > previous['leaked_tiles'] or report['leaked_objects'] > previous['leaked_objects']:
+            print('WARNING: possible leak - ' + str(report['leaked_tiles']) + ' Tiles and ' + str(report['leaked_objects']) + ' Objects outlived their level')
+
+    if report['current_mb'] > MEMORY_CEILING_MB:
+        print('WARNING: over the ' + str(MEMORY_CEILING_MB) + ' MB ceiling - dropping rewind history')
+        while len(snapshots) > 1:
+            snapshots.popleft()
+
+def wait_for_input():
+    # turn-based: sleep until there's input (or IDLE_WAIT_MS passes), then read it into key/mouse.
+    # Nothing happens between keypresses, so there's no point spinning at LIMIT_FPS.
+    # returns the event type - 0 means nothing we care about happened
+    event = renderer.wait_for_input(key, mouse, IDLE_WAIT_MS if TURN_BASED else 0)
+    if event & tcod.EVENT_KEY_PRESS or mouse.lbutton_pressed or mouse.rbutton_pressed:
+        note_input() # just keys and clicks - hover redraws would swamp the samples
+    return event
+
+#################################
+## Input Latency ################
+#################################
+
+# time from reading an input event to the frame showing its result being on screen
+
+input_latencies = deque(maxlen=LATENCY_SAMPLES) # ms
+last_input_time = None
+
+def note_input():
+    global last_input_time
+    last_input_time = time.perf_counter()
+
+def present():
+    # draw everything and put it on screen. If an input is waiting to be shown, that's one latency sample
+    global last_input_time, fov_recompute
+
+    if renderer.draws or spectators is not None:
+        render_all()
+    elif fov_recompute:
+        # nothing to draw, but what the player can see (and has explored) still matters to the game
+        fov_recompute = False
+        update_fov()
+    if renderer.draws:
+        renderer.draw(con, 0, 0, MAP_WIDTH, MAP_HEIGHT)
+        renderer.draw(panel, 0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT)
+        renderer.flush()
+    if spectators is not None:
+        spectators.broadcast(capture_frame()) # headless runs too - someone may be watching
+
+    if last_input_time is not None:
+        input_latencies.append((time.perf_counter() - last_input_time) * 1000)
+        last_input_time = None
+
+def latency_percentiles(samples=None):
+    # (p50, p99) in ms, or None before there's anything to measure. Defaults to the input latencies
+    if samples is None:
+        samples = input_latencies
+    if not samples:
+        return None
+    (p50, p99) = np.percentile(np.array(samples), [50, 99])
+    return (float(p50), float(p99))
+
+def instrumentation_report():
+    # everything we measure, in one place
+    report = {
+        'input_latency_ms': latency_percentiles(),
+        'input_samples': len(input_latencies),
+        'levels': list(level_stats),
+        'memory': memory_reports[-1] if memory_reports else None,
+        'autosave': autosave_report(),
+        'fov_cache': dict(fov_cache_stats, entries=len(fov_cache)),
+        'run': dict(run_stats),
+    }
+
+    if report['input_latency_ms'] is not None:
+        (p50, p99) = report['input_latency_ms']
+        print('Input latency: p50 ' + str(round(p50, 1)) + ' ms, p99 ' + str(round(p99, 1)) + ' ms over ' + str(report['input_samples']) + ' inputs')
+    if level_stats:
+        print('Level generation: ' + str(len(level_stats)) + ' levels, ' + str(round(sum(stats['ms'] for stats in level_stats) / len(level_stats), 1)) + ' ms average')
+    if run_stats:
+        print('This run: ' + ', '.join(name + ' ' + str(value) for (name, value) in sorted(run_stats.items())))
+    if fov_cache_stats['hits'] + fov_cache_stats['misses']:
+        print('FOV cache: ' + str(round(100 * fov_cache_stats['hits'] / (fov_cache_stats['hits'] + fov_cache_stats['misses']))) + '% hits, ' + str(len(fov_cache)) + ' entries, ' + str(fov_cache_stats['bytes']) + ' bytes')
+    if report['autosave'] is not None:
+        saves = report['autosave']
+        print('Autosave: ' + str(saves['saves']) + ' saves (' + str(saves['skipped']) + ' skipped), ' + str(round(saves['average_ms'], 1)) + ' ms average, ' + str(round(saves['max_ms'], 1)) + ' ms worst, ' + str(saves['bytes']) + ' bytes')
+    return report
+
 def play_game():
 
     global key, mouse
@@ -1398,49 +3413,856 @@ def play_game():
     mouse = tcod.Mouse()
     key = tcod.Key()
 
-    while not tcod.console_is_window_closed():
+    # render the screen
+    present()
 
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
+    while not renderer.closed():
 
-        # render the screen
-        render_all()
+        if check_level_up():
+            present() # show the new stats now, not after the next keypress
 
-        tcod.console_flush()
-        check_level_up()
+        if spectators is not None:
+            spectators.poll() # let new viewers in even while we're idle
 
-        #erase all objects at their old locations, before they move
-        for object in objects:
-            object.clear()
+        event = wait_for_input()
 
-        #player turn: handle keys and exit game if needed
-        player_action = handle_keys()
+        if event:
+            #erase all objects at their old locations, before they move
+            for object in objects:
+                object.clear()
 
-        if player_action == 'exit':
-            break
+            #player turn: handle keys and exit game if needed
+            player_action = handle_keys()
 
-        # monster turns
-        if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+            if player_action == 'exit':
+                break
 
+            # monster turns
+            if game_state == 'playing' and player_action != 'didnt-take-turn':
+                take_monster_turns()
 
-def main_menu():
-    img = tcod.image_load('skeletonSplash2.png')
+        elif TURN_BASED:
+            continue # idle - nothing to handle, nothing to redraw
+
+        # show the result of this input right away, in the same trip round the loop
+        present()
 
+    # quitting (or closing the window) saves; dying ends the run for good
+    if autosaver is None:
+        pass
+    elif game_state == 'dead':
+        autosaver.discard()
+    else:
+        autosave()
+        autosaver.wait()
+
+    instrumentation_report()
 
+def take_monster_turns():
+    global turn
+    update_senses()
 
-    while not tcod.console_is_window_closed():
+    for object in objects:
+        if object.ai:
+            object.ai.take_turn()
+
+    # end of the turn - wear off status effects, then remember it
+    turn += 1
+    status_effects.advance(turn)
+    take_snapshot()
+    if turn % AUTOSAVE_EVERY == 0:
+        autosave()
+
+#################################
+## Sessions #####################
+#################################
+
+# Everything that belongs to one game lives in module globals, so engine functions read and write "the" game.
+# A GameSession owns its own copy of all of that state; activating a session swaps its state into the globals (and
+# tucks the previous session's away), so one process can host and step any number of independent games:
+#
+#     session = GameSession()
+#     session.run(new_game)
+#     session.run(take_monster_turns)
+#
+# Swapping is a few dozen dict assignments - nothing is copied.
+
+SESSION_STATE = ('grid', 'objects', 'player', 'inventory', 'game_msgs', 'game_state', 'dungeon_level', 'fov_grid',
+    'fov_recompute', 'key', 'mouse', 'stairs', 'turn', 'con', 'panel', 'status_effects', 'blocked_map', 'level_serial',
+    'rooms', 'level_stats', 'explored_map', 'static_light_map', 'dark_colors', 'light_colors', 'light_fov_grid',
+    'flashes', 'region_map', 'region_centers', 'region_edges', 'route_cache', 'turn_cache_key', 'los_cache',
+    'retreat_distances', 'scent_map', 'noise_map', 'walkable_map', 'fov_cache', 'fov_cache_stats', 'decal_chars', 'decal_colors', 'decals', 'decals_drawn', 'render_layers', 'level_up_ready', 'run_stats', 'snapshots', 'autosaver', 'input_latencies',
+    'last_input_time', 'memory_reports', 'last_memory_snapshot')
+
+# what a brand new session starts from - the state as it is before any game has been made
+SESSION_DEFAULTS = copy.deepcopy({name: globals().get(name) for name in SESSION_STATE if name != 'autosaver'})
+
+# not counted towards any one session's memory - shared by all of them
+SHARED_TYPES = (type, type(sys), type(len), type(lambda: None), Autosaver)
+
+active_session = None
+live_sessions = [] # every session that hasn't been closed
+
+class GameSession:
+    def __init__(self, save_path=None, state=None):
+        # save_path: where this game autosaves, None for no autosave
+        if state is None:
+            state = copy.deepcopy(SESSION_DEFAULTS)
+            state['autosaver'] = Autosaver(save_path) if save_path else None
+        self.state = state
+        live_sessions.append(self)
+
+    def activate(self):
+        # make this the game the engine functions work on
+        global active_session
+
+        if active_session is self:
+            return
+        if active_session is not None:
+            active_session.state = {name: globals().get(name) for name in SESSION_STATE}
+        globals().update(self.state)
+        self.state = None # the globals are the real thing now - don't keep the old level alive through a stale copy
+        active_session = self
+
+    def run(self, function, *args):
+        # call an engine function on this game
+        self.activate()
+        return function(*args)
+
+    def get(self, name):
+        # one piece of this session's state, whether or not it's the active one
+        if active_session is self:
+            return globals().get(name)
+        return self.state.get(name)
+
+    def close(self):
+        # forget this game. Its state goes once nothing else refers to it
+        global active_session
+
+        if active_session is self:
+            for (name, value) in SESSION_DEFAULTS.items():
+                globals()[name] = copy.deepcopy(value)
+            globals()['autosaver'] = None # not in the defaults - and the closed game's saver mustn't pick up the next one's saves
+            active_session = None
+        self.state = {}
+        live_sessions.remove(self)
+
+    def memory_report(self):
+        # rough bytes reachable from this session's state. Classes, functions and modules are shared, so they
+        # don't count (and we don't go through them)
+        seen = set()
+        pending = [self.get(name) for name in SESSION_STATE]
+        total = 0
+
+        while pending:
+            obj = pending.pop()
+            if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            pending.extend(gc.get_referents(obj))
+
+        objects = self.get('objects') or ()
+        return {'bytes': total, 'objects': len(objects), 'snapshots': len(self.get('snapshots')),
+            'dungeon_level': self.get('dungeon_level'), 'turn': self.get('turn')}
+
+def session_memory_report():
+    # one line per live session
+    reports = []
+    for (i, session) in enumerate(live_sessions):
+        report = session.memory_report()
+        reports.append(report)
+        print('Session ' + str(i) + ': ' + str(round(report['bytes'] / 1024 / 1024, 2)) + ' MB, ' + str(report['objects']) + ' objects, ' + str(report['snapshots']) + ' snapshots, level ' + str(report['dungeon_level']) + ', turn ' + str(report['turn']))
+    return reports
+
+# the game played in the window - it owns whatever's in the globals right now, autosaving included
+GameSession(state={name: globals().get(name) for name in SESSION_STATE}).activate()
+
+##################
+## Spectators ####
+##################
+
+# Anyone on this machine can watch a game (or a headless bot run) from another terminal.
+# Every rendered frame of con + panel gets diffed against the one before it, and only the runs of changed cells are sent -
+# so a frame where the player takes one step costs a few hundred bytes, not the whole screen.
+#
+# Wire format: each message is a 4 byte length, then a type byte (K = keyframe, D = delta), a 2 byte run count,
+# and the runs: 2 byte start cell, 2 byte length, then that many cells (CELL_DTYPE, row-major over the screen).
+# Viewers send a single K byte to ask for a fresh keyframe (the viewer does this as soon as it connects).
+
+CELL_DTYPE = np.dtype([('ch', '<i4'), ('fg', 'u1', 3), ('bg', 'u1', 3)])
+
+def capture_frame():
+    # what's on screen, minus menus: con on top, panel underneath
+    frame = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), dtype=CELL_DTYPE)
+
+    for (console, top, height) in ((con, 0, min(MAP_HEIGHT, PANEL_Y)), (panel, PANEL_Y, PANEL_HEIGHT)):
+        width = min(console.width, SCREEN_WIDTH)
+        frame['ch'][top:top + height, :width] = console.ch[:height, :width]
+        frame['fg'][top:top + height, :width] = console.fg[:height, :width]
+        frame['bg'][top:top + height, :width] = console.bg[:height, :width]
+    return frame
+
+def encode_frame(frame, previous=None):
+    # keyframe if there's nothing to diff against, otherwise just the changed runs. Returns None if nothing changed
+    cells = frame.ravel()
+
+    if previous is None:
+        kind = b'K'
+        starts = np.array([0])
+        ends = np.array([cells.size])
+    else:
+        kind = b'D'
+        changed = (cells != previous.ravel()).astype(np.int8)
+        edges = np.diff(np.concatenate(([0], changed, [0])))
+        starts = np.nonzero(edges == 1)[0]
+        ends = np.nonzero(edges == -1)[0]
+        if starts.size == 0:
+            return None
+
+    parts = [kind, struct.pack('<H', starts.size)]
+    for (start, end) in zip(starts, ends):
+        parts.append(struct.pack('<HH', start, end - start))
+        parts.append(cells[start:end].tobytes())
+
+    body = b''.join(parts)
+    return struct.pack('<I', len(body)) + body
+
+def decode_frame(body, screen):
+    # apply one message body (no length prefix) to screen in place. returns the (start, length) runs that changed
+    run_count = struct.unpack_from('<H', body, 1)[0]
+    cells = screen.ravel()
+    offset = 3
+    runs = []
+
+    for i in range(run_count):
+        (start, length) = struct.unpack_from('<HH', body, offset)
+        offset += 4
+        size = length * CELL_DTYPE.itemsize
+        cells[start:start + length] = np.frombuffer(body, dtype=CELL_DTYPE, count=length, offset=offset)
+        offset += size
+        runs.append((start, length))
+    return runs
+
+class SpectatorServer:
+    # listens on a local socket, sends every frame to every viewer
+    def __init__(self, port=SPECTATE_PORT):
+        import socket
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((SPECTATE_HOST, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+
+        self.viewers = []
+        self.last_frame = None
+        self.bytes_sent = 0
+
+    def poll(self):
+        # accept new viewers, and answer keyframe requests. Never blocks
+        readable = select.select([self.listener] + self.viewers, [], [], 0)[0]
+
+        for sock in readable:
+            if sock is self.listener:
+                (viewer, address) = self.listener.accept()
+                viewer.settimeout(SPECTATE_SEND_TIMEOUT)
+                self.viewers.append(viewer)
+                if self.last_frame is not None:
+                    self.send(viewer, encode_frame(self.last_frame)) # keyframe first - deltas mean nothing on a blank screen
+            else:
+                try:
+                    request = sock.recv(64)
+                except OSError:
+                    request = b''
+
+                if not request:
+                    self.drop(sock) # viewer left
+                elif b'K' in request and self.last_frame is not None:
+                    self.send(sock, encode_frame(self.last_frame))
+
+    def broadcast(self, frame):
+        self.poll()
+
+        if self.viewers:
+            message = encode_frame(frame, self.last_frame)
+            if message is not None:
+                for viewer in list(self.viewers):
+                    self.send(viewer, message)
+
+        self.last_frame = frame
+
+    def send(self, viewer, message):
+        try:
+            viewer.sendall(message)
+            self.bytes_sent += len(message)
+        except OSError:
+            self.drop(viewer)
+
+    def drop(self, viewer):
+        if viewer in self.viewers:
+            self.viewers.remove(viewer)
+        viewer.close()
+
+spectators = None # a SpectatorServer while hosting spectators
+
+def host_spectators(port=SPECTATE_PORT):
+    global spectators
+    spectators = SpectatorServer(port)
+
+def read_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+# libtcod's sub-cell characters (image_blit_2x) as the matching unicode block elements
+ANSI_CHARS = {tcod.CHAR_SUBP_NW: '\u2598', tcod.CHAR_SUBP_NE: '\u259d', tcod.CHAR_SUBP_N: '\u2580', tcod.CHAR_SUBP_SE: '\u2597',
+    tcod.CHAR_SUBP_DIAG: '\u259a', tcod.CHAR_SUBP_E: '\u2590', tcod.CHAR_SUBP_SW: '\u2596'}
+
+def ansi_cell(index, cell):
+    # escape sequence that draws one cell at its spot in a 24-bit color terminal
+    (y, x) = divmod(index, SCREEN_WIDTH)
+    (fr, fg, fb) = cell['fg']
+    (br, bg, bb) = cell['bg']
+    char = ANSI_CHARS.get(int(cell['ch'])) or (chr(cell['ch']) if cell['ch'] > 32 else ' ')
+    return '\x1b[' + str(y + 1) + ';' + str(x + 1) + 'H\x1b[38;2;' + str(fr) + ';' + str(fg) + ';' + str(fb) + 'm\x1b[48;2;' + str(br) + ';' + str(bg) + ';' + str(bb) + 'm' + char
+
+def watch(port=SPECTATE_PORT):
+    # spectator side: connect, ask for a keyframe, then redraw whatever changed in this terminal
+    import socket
+    sock = socket.create_connection((SPECTATE_HOST, port))
+    sock.sendall(b'K')
+
+    screen = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), dtype=CELL_DTYPE)
+    out = ['\x1b[2J\x1b[?25l'] # clear, hide cursor
+
+    try:
+        while True:
+            header = read_exactly(sock, 4)
+            if header is None:
+                break
+            body = read_exactly(sock, struct.unpack('<I', header)[0])
+            if body is None:
+                break
+
+            cells = screen.ravel()
+            for (start, length) in decode_frame(body, screen):
+                for index in range(start, start + length):
+                    out.append(ansi_cell(index, cells[index]))
+
+            out.append('\x1b[0m')
+            print(''.join(out), end='', flush=True)
+            out = []
+    finally:
+        print('\x1b[0m\x1b[?25h')
+        sock.close()
+
+##################
+## Server ########
+##################
+
+# Lots of players, one process: every connection gets its own GameSession, and an asyncio loop switches between them.
+# A keystroke becomes the same tcod.Key the window would have given handle_keys, the turn runs, and whatever changed
+# on screen goes back as ANSI escapes - so plain telnet (or nc) in a 24-bit color terminal is the client.
+# Turns are quick and run right on the loop; digging levels isn't, so that goes to a shared pool of worker processes
+# while everyone else keeps playing.
+
+TELNET_CHAR_MODE = b'\xff\xfb\x01\xff\xfb\x03' # IAC WILL ECHO, IAC WILL SUPPRESS-GO-AHEAD: send keys as they're typed
+ARROW_KEYS = {b'A': tcod.KEY_UP, b'B': tcod.KEY_DOWN, b'C': tcod.KEY_RIGHT, b'D': tcod.KEY_LEFT}
+
+worker_barrier = None # in a level worker: the barrier every worker meets at when the pool starts (see worker_pool)
+
+def join_worker_pool(barrier):
+    # runs in each worker as it starts
+    global worker_barrier
+    worker_barrier = barrier
+
+def wait_for_workers():
+    # warm-up job: keeps its worker busy until every worker has one, so no two of them land on the same process
+    try:
+        worker_barrier.wait(WORKER_START_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass # one didn't start in time - it'll still start once there's work for it
+
+def worker_pool(workers=None):
+    # processes to dig levels in, all started right away. Started fresh rather than forked: a fork copies the window,
+    # the autosave thread and every open socket (so a quitting telnet player's connection would stay open) into each
+    # worker. None = one per core
+    import concurrent.futures, multiprocessing # only --serve and --best-of need these - keep them out of startup
+
+    workers = workers or os.cpu_count() or 1
+    context = multiprocessing.get_context('spawn')
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=join_worker_pool, initargs=(context.Barrier(workers),))
+
+    # the pool only starts another process for a job when none is idle. One job per worker, each holding its worker
+    # until they've all arrived, gets every process going now - not one at a time, as level changes happen to find
+    # the others busy
+    for i in range(workers):
+        pool.submit(wait_for_workers)
+    return pool
+
+def generate_level(level_number, seed):
+    # runs in a worker process: dig a level in a throwaway session, and hand back what install_level needs
+    global player, dungeon_level
+
+    session = GameSession()
+    session.activate()
+    random.seed(seed) # workers start out with the same random state - don't let them all dig the same level
+    tcod.random_restore(tcod.random_get_instance(), tcod.random_new_from_seed(seed)) # place_objects rolls on tcod's
+    player = Object(0, 0, '@', 'player', tcod.white, blocks=True) # stand-in, just so there's somewhere to start
+    dungeon_level = level_number
+    make_grid()
+
+    level = {'blocked': blocked_map.copy(), 'rooms': rooms, 'objects': [obj for obj in objects if obj is not player],
+        'stairs': stairs, 'start': (player.x, player.y), 'stats': level_stats[-1]}
+    level['metrics'] = level_metrics(level) # scored here, so it happens in parallel too
+    session.close()
+    return level
+
+##################
+## Best-of-N #####
+##################
+
+# make_grid's layouts vary a lot - a handful of rooms, stairs right by the start, corridors to nowhere. With BEST_OF > 1
+# every level change digs several candidates at once in a process pool, scores each with whole-map numpy metrics, and
+# keeps the best. Whatever isn't done when LEVEL_BUDGET_MS runs out is dropped, so a level change never takes longer.
+
+level_pool = None # worker processes for candidate levels, started the first time they're needed
+
+def candidate_seeds(seed, level_number, count):
+    # the same seed and dungeon level always give the same candidates
+    rng = random.Random(seed * 1000 + level_number)
+    return [rng.getrandbits(32) for i in range(count)]
+
+def walk_distance(walkable, start, goal):
+    # steps from start to goal, 4-way - the reachable area grown one step per pass, as arrays. None if unreachable
+    reached = np.zeros_like(walkable)
+    reached[start] = True
+    steps = 0
+
+    while not reached[goal]:
+        grown = reached.copy()
+        grown[1:, :] |= reached[:-1, :]
+        grown[:-1, :] |= reached[1:, :]
+        grown[:, 1:] |= reached[:, :-1]
+        grown[:, :-1] |= reached[:, 1:]
+        grown &= walkable
+        if np.array_equal(grown, reached):
+            return None
+        reached = grown
+        steps += 1
+    return steps
+
+def level_metrics(level):
+    # raw numbers describing a layout
+    walkable = ~level['blocked']
+    area = int(np.count_nonzero(walkable))
+
+    padded = np.pad(walkable, 1).astype(np.int8)
+    neighbours = padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+    dead_ends = int(np.count_nonzero(walkable & (neighbours == 1)))
+
+    # loops = holes in the floor. The floor is one connected piece (connect_regions sees to that), so by Euler's
+    # formula holes = 1 - (tiles - touching pairs + fully-floored 2x2 squares)
+    pairs = np.count_nonzero(walkable[:-1, :] & walkable[1:, :]) + np.count_nonzero(walkable[:, :-1] & walkable[:, 1:])
+    squares = np.count_nonzero(walkable[:-1, :-1] & walkable[1:, :-1] & walkable[:-1, 1:] & walkable[1:, 1:])
+    loops = max(0, int(1 - (area - pairs + squares)))
+
+    stairs = level['stairs']
+    path = walk_distance(walkable, level['start'], (stairs.x, stairs.y))
+    spawns = sum(1 for obj in level['objects'] if obj.fighter or obj.item)
+
+    return {'area': area, 'path': path, 'rooms': len(level['rooms']), 'loops': loops, 'dead_ends': dead_ends,
+        'density': spawns / max(area, 1)}
+
+def score_level(metrics):
+    # bigger is better. Each metric is scaled to roughly 0..1 before it's weighted
+    if metrics['path'] is None:
+        return float('-inf') # can't reach the stairs - never pick this one
+    scaled = {
+        'area': metrics['area'] / (MAP_WIDTH * MAP_HEIGHT),
+        'path': metrics['path'] / (MAP_WIDTH + MAP_HEIGHT),
+        'rooms': min(metrics['rooms'], 30) / 30,
+        'loops': min(metrics['loops'], 4) / 4,
+        'dead_ends': min(metrics['dead_ends'], 20) / 20,
+        'density': abs(metrics['density'] - SPAWN_DENSITY_TARGET) / SPAWN_DENSITY_TARGET,
+    }
+    return sum(LEVEL_SCORE_WEIGHTS[name] * value for (name, value) in scaled.items())
+
+def pick_best_level(levels, start):
+    # highest score wins (first one dug, on a tie). Its stats note how the choice went
+    scores = [score_level(level['metrics']) for level in levels]
+    best = max(range(len(levels)), key=lambda i: (scores[i], -i))
+    level = levels[best]
+
+    level['stats'] = dict(level['stats'], candidates=len(levels), score=scores[best], best_of_ms=(time.perf_counter() - start) * 1000)
+    print('Best of ' + str(len(levels)) + ' levels: score ' + str(round(scores[best], 2)) + ' (worst ' + str(round(min(scores), 2)) + ') in ' + str(round(level['stats']['best_of_ms'], 1)) + ' ms ' + str(level['metrics']))
+    return level
+
+def start_level_pool():
+    # workers take a moment to start up - do that now, not during the first level change
+    global level_pool
+
+    if level_pool is None:
+        level_pool = worker_pool(BEST_OF) # a process per candidate
+
+def finished_levels(futures, done):
+    # the levels from the candidates in `done`, in submission order (so ties don't depend on which worker was quicker).
+    # A candidate that crashed is left out - it shouldn't take the whole level change down with it
+    levels = []
+    for future in futures:
+        if future not in done or future.cancelled():
+            continue
+        if future.exception() is not None:
+            print('Candidate level failed: ' + repr(future.exception()))
+        else:
+            levels.append(future.result())
+    return levels
+
+def generate_best_level(level_number, seed, count=None, budget_ms=LEVEL_BUDGET_MS):
+    # dig `count` candidates (BEST_OF by default) in the pool and keep the best of whatever's ready in budget_ms
+    import concurrent.futures
+
+    start = time.perf_counter()
+    start_level_pool()
+    futures = [level_pool.submit(generate_level, level_number, candidate) for candidate in candidate_seeds(seed, level_number, count or BEST_OF)]
+    (done, pending) = concurrent.futures.wait(futures, timeout=budget_ms / 1000)
+    levels = finished_levels(futures, done)
+    while not levels and pending:
+        (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        levels = finished_levels(futures, done)
+    for future in pending:
+        future.cancel()
+
+    if not levels:
+        return None # every candidate failed - the caller digs one itself
+    return pick_best_level(levels, start)
+
+def parse_keys(data, flush=False):
+    # raw terminal bytes -> (list of tcod.Keys, leftover bytes that might be the start of a longer sequence)
+    # flush: nothing more arrived within ESCAPE_WAIT_MS, so a lone ESC at the end is the escape key after all
+    keys = []
+    i = 0
+    while i < len(data):
+        byte = data[i:i + 1]
+
+        if byte == b'\xff':
+            # telnet command - skip it
+            if i + 3 > len(data):
+                break
+            i += 3
+        elif byte == b'\x1b':
+            if i + 1 == len(data):
+                if not flush:
+                    break # the rest of an arrow key may be in the next read - wait and see
+                keys.append(tcod.Key(vk=tcod.KEY_ESCAPE)) # nothing followed it, so it's the escape key itself
+                i += 1
+            elif data[i + 1:i + 2] != b'[':
+                keys.append(tcod.Key(vk=tcod.KEY_ESCAPE))
+                i += 1
+            elif i + 3 > len(data):
+                break
+            else:
+                if data[i + 2:i + 3] in ARROW_KEYS:
+                    keys.append(tcod.Key(vk=ARROW_KEYS[data[i + 2:i + 3]]))
+                i += 3
+        elif byte == b'\r' or (byte == b'\n' and data[i - 1:i] != b'\r'):
+            keys.append(tcod.Key(vk=tcod.KEY_ENTER, c=13)) # telnet sends \r\n (or \r\0), a cbreak terminal just \n
+            i += 1
+        else:
+            if byte not in (b'\n', b'\x00'):
+                keys.append(tcod.Key(vk=tcod.KEY_CHAR, c=data[i]))
+            i += 1
+    return (keys, data[i:])
+
+def apply_key(key_press):
+    # one trip round play_game's loop for the active session, minus the waiting and drawing. Returns handle_keys' action
+    global key
+
+    key = key_press
+    for object in objects:
+        object.clear()
+
+    action = handle_keys()
+    if game_state == 'playing' and action not in ('didnt-take-turn', 'exit'):
+        take_monster_turns()
+    return action
+
+# spells that stop and ask for a tile - over the network that's asked first, with a cursor, and handed over in preset_target
+TARGETED_SPELLS = {cast_confuse: CONFUSE_RANGE, cast_fireball: None}
+
+def open_menu(name):
+    # what a network player sees after pressing one of NETWORK_MENUS: a menu, or (travel) a cursor on the player
+    if name == 'travel':
+        return ('travel', None, player.x, player.y)
+    return name
+
+def apply_menu_key(choosing, key_press):
+    # a key for the active session's open menu (see open_menu). Returns what's open next - None once it's closed.
+    # Same rules as the window: a letter picks, anything else cancels
+    global preset_target
+
+    char = chr(key_press.c) if key_press.vk == tcod.KEY_CHAR else ''
+    if choosing in ('use', 'drop'):
+        index = ord(char) - ord('a') if char else -1
+        if not 0 <= index < len(inventory):
+            return None
+        item = inventory[index].item
+        if choosing == 'drop':
+            item.drop()
+        elif item.use_function in TARGETED_SPELLS:
+            return ('target', item, player.x, player.y)
+        else:
+            item.use()
+        return None
+
+    if choosing == 'sheet':
+        return None
+
+    # a cursor: arrows move it, Enter (or '.') picks the tile under it
+    (kind, item, x, y) = choosing
+    if key_press.vk in CURSOR_MOVES:
+        (dx, dy) = CURSOR_MOVES[key_press.vk]
+        return (kind, item, min(max(x + dx, 0), MAP_WIDTH - 1), min(max(y + dy, 0), MAP_HEIGHT - 1))
+
+    if key_press.vk == tcod.KEY_ENTER or char == '.':
+        if kind == 'travel':
+            if targetable(x, y, explored_ok=True):
+                travel(lambda: [(x, y)])
+        else:
+            preset_target = (x, y)
+            try:
+                item.use()
+            finally:
+                preset_target = None
+    return None
+
+def draw_menu(frame, choosing):
+    # an open menu on top of the active session's frame. Returns the prompt line to go under it
+    if choosing in ('use', 'drop'):
+        (header, options, width) = (USE_HEADER if choosing == 'use' else DROP_HEADER, inventory_options(), INVENTORY_WIDTH)
+    elif choosing == 'sheet':
+        (header, options, width) = (character_sheet(), [], CHARACTER_SCREEN_WIDTH)
+    else:
+        (kind, item, x, y) = choosing
+        frame[y, x]['bg'] = CURSOR_COLOR
+        if kind == 'travel':
+            return 'Travel: arrows move the cursor, Enter goes there, any other key cancels.'
+        return 'Target for ' + item.owner.name + ': arrows move the cursor, Enter casts, any other key cancels.'
+
+    (window, x, y, height) = menu_window(header, options, width)
+    draw_cells(frame, window, x, y, width, height, 0.7)
+    return None
+
+def render_frame():
+    # draw the active session and grab the result
+    global mouse
+
+    if mouse is None:
+        mouse = tcod.Mouse() # no mouse over the network - nothing's ever under it
+    render_all()
+    return capture_frame()
+
+def ansi_frame(frame, previous=None, prompt=None):
+    # escape sequences that turn `previous` into `frame` on the client's terminal (everything if previous is None),
+    # plus an optional prompt line under the screen
+    cells = frame.ravel()
+    if previous is None:
+        changed = np.arange(cells.size)
+    else:
+        changed = np.nonzero(cells != previous.ravel())[0]
+
+    out = [ansi_cell(index, cells[index]) for index in changed.tolist()]
+    out.append('\x1b[0m\x1b[' + str(SCREEN_HEIGHT + 1) + ';1H\x1b[2K')
+    if prompt:
+        out.append(prompt)
+    return ''.join(out).encode()
+
+class GameServer:
+    def __init__(self, workers=SERVE_WORKERS):
+        self.pool = worker_pool(workers)
+        self.sessions = set()
+        self.turn_latencies = deque(maxlen=LATENCY_SAMPLES) # ms from keystroke in to screen out, awaits included
+        self.turn_work = deque(maxlen=LATENCY_SAMPLES) # ms the loop itself was busy for each of those
+        self.turns = 0
+
+    async def dig(self, level_number):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        seed = random.getrandbits(32)
+        if BEST_OF <= 1:
+            return await loop.run_in_executor(self.pool, generate_level, level_number, seed)
+
+        # best of N, same rules as generate_best_level - but waiting on the loop, not blocking it
+        start = time.perf_counter()
+        futures = [loop.run_in_executor(self.pool, generate_level, level_number, candidate) for candidate in candidate_seeds(seed, level_number, BEST_OF)]
+        (done, pending) = await asyncio.wait(futures, timeout=LEVEL_BUDGET_MS / 1000)
+        levels = finished_levels(futures, done)
+        while not levels and pending:
+            (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            levels = finished_levels(futures, done)
+        for future in pending:
+            future.cancel()
+
+        if not levels:
+            return None # every candidate failed - next_level digs one itself
+        return pick_best_level(levels, start)
+
+    async def handle(self, reader, writer):
+        # one connected player, start to finish
+        import asyncio
+        session = GameSession()
+        self.sessions.add(session)
+        leveling = False
+        choosing = None # the open menu, if any (see open_menu)
+
+        try:
+            writer.write(TELNET_CHAR_MODE + b'\x1b[2J\x1b[?25l')
+            session.run(new_game, await self.dig(1))
+            previous = session.run(render_frame)
+            writer.write(ansi_frame(previous))
+            await writer.drain()
+
+            pending = b''
+            while session.get('game_state') != 'dead':
+                try:
+                    # a lone ESC waits a moment for the rest of an arrow key that got split across reads
+                    data = await asyncio.wait_for(reader.read(1024), ESCAPE_WAIT_MS / 1000 if pending == b'\x1b' else None)
+                    if not data:
+                        break
+                    (keys, pending) = parse_keys(pending + data)
+                except asyncio.TimeoutError:
+                    (keys, pending) = parse_keys(pending, flush=True)
+
+                for key_press in keys:
+                    start = time.perf_counter()
+                    waited = 0 # time spent waiting on the pool, when other sessions had the loop
+                    char = chr(key_press.c) if key_press.vk == tcod.KEY_CHAR else ''
+
+                    session.activate()
+                    if leveling:
+                        # waiting on a stat choice - nothing else until they pick one
+                        if char in ('a', 'b', 'c'):
+                            level_up(ord(char) - ord('a'))
+                            leveling = False
+                    elif choosing is not None:
+                        choosing = apply_menu_key(choosing, key_press)
+                    elif game_state == 'playing' and char in NETWORK_MENUS:
+                        choosing = open_menu(NETWORK_MENUS[char])
+                    elif char == ',' and (stairs.x, stairs.y) == (player.x, player.y):
+                        # down the stairs - dig the next level in the pool
+                        digging = time.perf_counter()
+                        level = await self.dig(session.get('dungeon_level') + 1)
+                        waited = time.perf_counter() - digging
+                        session.run(next_level, level)
+                    elif key_press.vk == tcod.KEY_CHAR and char not in NETWORK_KEYS:
+                        message('Not available over the network.', tcod.light_gray)
+                    elif apply_key(key_press) == 'exit':
+                        return
+
+                    session.activate()
+                    prompt = None
+                    if not leveling and game_state == 'playing' and level_up_ready:
+                        leveling = True
+                    if leveling:
+                        choosing = None
+                        options = level_up_options()
+                        prompt = 'Level up! ' + '  '.join(chr(ord('a') + i) + ') ' + option for (i, option) in enumerate(options))
+
+                    frame = render_frame()
+                    if choosing is not None:
+                        prompt = draw_menu(frame, choosing)
+                    writer.write(ansi_frame(frame, previous, prompt))
+                    previous = frame
+                    self.turn_work.append((time.perf_counter() - start - waited) * 1000)
+                    await writer.drain()
+
+                    self.turns += 1
+                    self.turn_latencies.append((time.perf_counter() - start) * 1000)
+
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(session)
+            session.close()
+            writer.close()
+
+    def report(self):
+        cores = os.cpu_count() or 1
+        report = {
+            'sessions': len(self.sessions),
+            'sessions_per_core': len(self.sessions) / cores,
+            'turns': self.turns,
+            'turn_latency_ms': latency_percentiles(self.turn_latencies),
+            'turn_work_ms': sum(self.turn_work) / len(self.turn_work) if self.turn_work else None,
+        }
+
+        line = 'Server: ' + str(report['sessions']) + ' sessions (' + str(round(report['sessions_per_core'], 1)) + ' per core), ' + str(report['turns']) + ' turns'
+        if report['turn_latency_ms'] is not None:
+            (p50, p99) = report['turn_latency_ms']
+            line += ', turn latency p50 ' + str(round(p50, 1)) + ' ms, p99 ' + str(round(p99, 1)) + ' ms'
+            # one core can keep up with this many turns a second - divide by how often a player presses a key
+            line += ', ' + str(round(report['turn_work_ms'], 2)) + ' ms work per turn (~' + str(round(1000 / max(report['turn_work_ms'], 0.001))) + ' turns/s per core)'
+        print(line)
+        return report
+
+    async def report_forever(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(SERVE_METRICS_INTERVAL)
+            self.report()
+
+async def serve(port=SERVE_PORT, workers=SERVE_WORKERS):
+    import asyncio
+    server = GameServer(workers)
+    listener = await asyncio.start_server(server.handle, SERVE_HOST, port)
+    print('Serving games on ' + SERVE_HOST + ':' + str(port) + ' - connect with: telnet ' + SERVE_HOST + ' ' + str(port))
+
+    reporter = asyncio.ensure_future(server.report_forever())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        reporter.cancel()
+        server.report()
+        server.pool.shutdown()
+
+def render_menu_background():
+    # splash art + titles never change, so draw them once to an offscreen console and just blit that each time round
+    global menu_background
+
+    if menu_background is None:
+        menu_background = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
 
         #show image at double console res
-        tcod.image_blit_2x(img, 0, 0, 0)
+        tcod.image_blit_2x(load_image(SPLASH_FILE), menu_background, 0, 0)
 
         #show the game's title, and some credits!
-        tcod.console_set_default_foreground(0, tcod.red)
-        tcod.console_print_ex(0, SCREEN_WIDTH//2, SCREEN_HEIGHT//2-4, tcod.BKGND_NONE, tcod.CENTER,
+        tcod.console_set_default_foreground(menu_background, tcod.red)
+        tcod.console_print_ex(menu_background, SCREEN_WIDTH//2, SCREEN_HEIGHT//2-4, tcod.BKGND_NONE, tcod.CENTER,
             'Spooky Spooky Skellies')
-        tcod.console_print_ex(0, SCREEN_WIDTH//2, SCREEN_HEIGHT-2, tcod.BKGND_NONE, tcod.CENTER,
+        tcod.console_print_ex(menu_background, SCREEN_WIDTH//2, SCREEN_HEIGHT-2, tcod.BKGND_NONE, tcod.CENTER,
             'By Boo Radley Productions')
+    return menu_background
+
+def report_startup():
+    # how long from launch until the menu is up
+    startup_ms = (time.perf_counter() - START_TIME) * 1000
+    print('Startup: ' + str(round(startup_ms)) + ' ms (budget ' + str(STARTUP_BUDGET_MS) + ' ms)')
+    if startup_ms > STARTUP_BUDGET_MS:
+        print('WARNING: startup over budget!')
+
+def main_menu():
+    renderer.open()
+    background = render_menu_background()
+    report_startup()
+
+    while not renderer.closed():
+
+        renderer.draw(background, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
 
         #show options and wait on player's choice
         choice = menu('', ['Play a new game', 'Continue last game', 'Quit'], 24)
@@ -1449,16 +4271,46 @@ def main_menu():
             new_game()
             play_game()
 
+        elif choice == 1:
+            if load_game():
+                play_game()
+            else:
+                msgbox('\n No saved game to load.\n', 24)
+
         elif choice == 2:
             break
 
-main_menu()
-
-
-
-
-
-
-
-
-
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Spooky Spooky Skellies')
+    parser.add_argument('--spectators', action='store_true', help='let other terminals on this machine watch the game')
+    parser.add_argument('--watch', action='store_true', help='watch a game hosted with --spectators')
+    parser.add_argument('--renderer', choices=sorted(RENDERERS), default='tcod', help="where the game's drawn - a window, this terminal (ansi), or nowhere (null)")
+    parser.add_argument('--best-of', type=int, default=BEST_OF, help='dig this many candidate levels per level change and keep the best')
+    parser.add_argument('--serve', action='store_true', help='host games for telnet clients on this machine (no window)')
+    parser.add_argument('--port', type=int, default=None, help='spectator / server port')
+    parser.add_argument('--wizard', action='store_true', help="wizard mode - 'u' rewinds a turn")
+    parser.add_argument('--memory', action='store_true', help='report memory use and leaks at every level change')
+    args = parser.parse_args()
+
+    WIZARD_MODE = args.wizard
+    renderer = RENDERERS[args.renderer]()
+    BEST_OF = args.best_of
+    if BEST_OF > 1 and not args.serve:
+        start_level_pool() # (the server has its own)
+    MEMORY_INSTRUMENTATION = args.memory
+
+    if args.serve:
+        try:
+            import asyncio # the server's the only thing that needs it
+            asyncio.run(serve(args.port or SERVE_PORT))
+        except KeyboardInterrupt:
+            pass
+    elif args.watch:
+        watch(args.port or SPECTATE_PORT)
+    else:
+        if args.spectators:
+            host_spectators(args.port or SPECTATE_PORT)
+        try:
+            main_menu()
+        finally:
+            renderer.close()